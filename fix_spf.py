@@ -254,51 +254,54 @@ def check_intermediate_unclassified(orig_spf, col_count):
 
     max_col_i = col_count - 1
 
-    # Making a copy of this dataframe because the pandas dataframe being iterated
-    # over should not be modified.
+    # Making a copy of this dataframe so that the input is not modified.
     new_spf = orig_spf.copy()
 
-    for row_i, row in orig_spf.iterrows():
-
-        taxa = list(orig_spf.iloc[row_i, 0:max_col_i])
-
-        unclassified_i = []
-        classified_i = []
-
-        for i, t in enumerate(taxa):
-            if t == 'Unclassified':
-                unclassified_i.append(i)
-            else:
-                classified_i.append(i)
-
-        if unclassified_i and min(unclassified_i) < max(classified_i):
-
-            # Check whether first level is classified or not.
-            if taxa[0] == 'Unclassified':
-                sys.exit("Stopping - first level of this lineage is Unclassified, "
-                         "but lower levels are classified:\n" + " ".join(taxa))
-
-            # For any cases of intermediate Unclassified labels, fill in the
-            # nearest classified parent label followed by X's equal to the number
-            # of steps away this classified label is.
-            for unclass_i in unclassified_i:
-
-                if unclass_i < max(classified_i):
-                    current_i = unclass_i
-                    unclassified_steps = 1
-
-                    while current_i > 0:
-                        current_i -= 1
-
-                        if taxa[current_i] == 'Unclassified' or \
-                           current_i not in classified_i:
-                            unclassified_steps += 1
-                            next
-                        else:
-                            taxa[unclass_i] = taxa[current_i] + "_" + "X" * unclassified_steps
-                            break
-
-        new_spf.iloc[row_i, 0:max_col_i] = taxa
+    if max_col_i < 1 or len(orig_spf) == 0:
+        return(new_spf)
+
+    # Work on the distinct lineages only (in order of first appearance) as a
+    # matrix of labels; lineage_codes maps every row to its lineage.
+    label_cols = list(orig_spf.columns[0:max_col_i])
+    lineage_codes = orig_spf.groupby(label_cols, sort=False,
+                                     dropna=False).ngroup().to_numpy()
+    first_rows = np.unique(lineage_codes, return_index=True)[1]
+    taxa = orig_spf.iloc[first_rows, 0:max_col_i].to_numpy(dtype=object)
+
+    unclassified = taxa == 'Unclassified'
+    level_i = np.arange(max_col_i)
+
+    # Index of the last classified level of each lineage and of the nearest
+    # classified level at or above each level (-1 if there is none).
+    classified_i = np.where(unclassified, -1, level_i)
+    last_classified_i = classified_i.max(axis=1)
+    prior_classified_i = np.maximum.accumulate(classified_i, axis=1)
+
+    # Intermediate Unclassified labels: those above a classified level.
+    intermediate = unclassified & (level_i < last_classified_i[:, None])
+    lineages2change = intermediate.any(axis=1)
+
+    if not lineages2change.any():
+        return(new_spf)
+
+    # Check whether first level is classified or not.
+    unclassified_top = lineages2change & unclassified[:, 0]
+    if unclassified_top.any():
+        sys.exit("Stopping - first level of this lineage is Unclassified, "
+                 "but lower levels are classified:\n" +
+                 " ".join(taxa[np.argmax(unclassified_top)]))
+
+    # For any cases of intermediate Unclassified labels, fill in the
+    # nearest classified parent label followed by X's equal to the number
+    # of steps away this classified label is.
+    lineage_i, unclass_i = np.nonzero(intermediate)
+    parent_i = prior_classified_i[lineage_i, unclass_i]
+    steps = unclass_i - parent_i
+    taxa[lineage_i, unclass_i] = taxa[lineage_i, parent_i] + "_" + \
+        np.array(["X" * n for n in steps], dtype=object)
+
+    rows2change = np.flatnonzero(lineages2change[lineage_codes])
+    new_spf.iloc[rows2change, 0:max_col_i] = taxa[lineage_codes[rows2change]]
 
     return(new_spf)
 
@@ -318,36 +321,40 @@ def force_strict_spf_hierarchy(in_spf, col_count):
 
         current_col = in_spf.columns[i]
         prior_col = in_spf.columns[i - 1]
-        unique_labels = in_spf[current_col].unique()
-
-        for label in unique_labels:
-
-            # Skip Unclassified labels.
-            if label == "Unclassified":
-                continue
-
-            matching_rows = in_spf[current_col] == label
 
-            # Skip if only 1 matching row.
-            if np.sum(matching_rows) == 1:
-                continue
-
-            # Otherwise check whether all the parents are identical.
-            unique_parents = in_spf.loc[in_spf[current_col] == label, prior_col].unique()
-
-            # If multiple parents (i.e. not a strict hierarchy) then add
-            # "_dupN" to all children with different parents, where N is the
-            # parent's index in the above list.
-            if len(unique_parents) > 1:
-                for idx, p in enumerate(unique_parents):
-                    new_label = label + "_dup" + str(idx)
+        # Skip Unclassified (and missing) labels.
+        labelled = in_spf[current_col].notna() & \
+                   (in_spf[current_col] != "Unclassified")
+        pairs = pd.DataFrame({'label': in_spf.loc[labelled, current_col],
+                              'parent': in_spf.loc[labelled, prior_col]})
+
+        # Number each distinct label/parent pair in order of first appearance
+        # and take the first row of each pair.
+        pair_codes = pairs.groupby(['label', 'parent'], sort=False,
+                                   dropna=False).ngroup().to_numpy()
+        first_rows = np.unique(pair_codes, return_index=True)[1]
+        unique_pairs = pairs.iloc[first_rows].reset_index(drop=True)
+
+        # Index of each parent among the parents of its label (in order of
+        # first appearance) and number of parents per label.
+        by_label = unique_pairs.groupby('label', sort=False)['parent']
+        parent_idx = by_label.cumcount()
+        parent_count = by_label.transform('size')
+
+        # If multiple parents (i.e. not a strict hierarchy) then add
+        # "_dupN" to all children with different parents, where N is the
+        # parent's index. Rows with a missing parent keep their label.
+        dup_pairs = ((parent_count > 1) & unique_pairs['parent'].notna()).to_numpy()
+
+        if not dup_pairs.any():
+            continue
 
-                    # Identify rows matching the label and parent value of
-                    # interest.
-                    rows2change = np.logical_and(matching_rows,
-                                                 in_spf[prior_col] == p)
+        new_labels = (unique_pairs['label'] + "_dup" +
+                      parent_idx.astype(str)).to_numpy()
+        rows2change = dup_pairs[pair_codes]
 
-                    in_spf.loc[rows2change, current_col] = new_label
+        in_spf.loc[pairs.index[rows2change], current_col] = \
+            new_labels[pair_codes[rows2change]]
 
     return(in_spf)
 
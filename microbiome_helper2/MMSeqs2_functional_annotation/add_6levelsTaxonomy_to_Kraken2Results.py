@@ -1,39 +1,74 @@
 import argparse, sys, textwrap
 import re
 import csv
-from collections import defaultdict
+from collections import defaultdict, Counter
 import numpy as np
 import pandas as pd
+import os
+import tempfile
 import logging
 logger = logging.getLogger(__name__)
 
-import urllib
-
 #from taxadb.taxid import TaxID
-from ete3 import NCBITaxa
 from ete3 import PhyloTree
 #from ete3 import NCBITaxa
-ncbi = NCBITaxa()
-try:
-    response = urllib.request.urlopen('https://ftp.ncbi.nlm.nih.gov/pub/taxonomy/')
-    ncbi.update_taxonomy_database()
-except urllib.error.URLError as e:
-    logger.error('URLError: %s', e)
+from ncbi_taxdb import add_taxdb_arguments, set_taxonomy_db, get_ncbi, build_taxonomy_db, taxonomy_db_version
 
 
 parser=argparse.ArgumentParser()
 
 parser.add_argument('--taxafilelist', help = 'List of files mapping the reads to Taxa')
 parser.add_argument('--outfile', help = 'File to write the taxonomy count matrix')
+add_taxdb_arguments(parser)
+parser.add_argument('--lineage_cache', help = 'Tab-delimited taxid to 6-rank lineage table reused across runs; read if it exists and was built from the same taxonomy database, rebuilt if not, and extended with any newly resolved taxids')
+parser.add_argument('--build_lineage_cache', action = 'store_true', help = 'Write the lineage of every taxid in the ete3 database to --lineage_cache and exit')
+
+rank_search_string = "phylum,class,order,family,genus,species"
+prefix_dict = {
+    "phylum": "p_",
+    "class": "c_",
+    "order": "o_",
+    "family": "f_",
+    "genus": "g_",
+    "species": "s_"
+    }
+
+# taxid -> 6-rank lineage string (None if the taxid has no lineage), so each
+# taxid is looked up in the ete3 SQLite database at most once
+lineage_cache = {}
 
 def main():
     args = parser.parse_args()
+    
+    set_taxonomy_db(args.taxdb, args.update_taxonomy)
+    
+    if (args.build_taxdb):
+        build_taxonomy_db(args.taxdb, args.taxdump)
+        return
     multifilelist = args.taxafilelist
     outfile = args.outfile
     
+    if (args.build_lineage_cache):
+        if not args.lineage_cache:
+            sys.exit('--build_lineage_cache needs --lineage_cache to write to')
+        taxids = [str(row[0]) for row in get_ncbi().db.execute('SELECT taxid FROM species')]
+        print ("Resolving lineages of", len(taxids), "taxids")
+        for id in taxids:
+            resolve_lineage(id, rank_search_string, prefix_dict)
+        write_lineage_cache(args.lineage_cache, lineage_cache)
+        return
+    
+    if (args.lineage_cache):
+        if (args.update_taxonomy):
+            # Update first, so the cache is checked against the updated database
+            get_ncbi()
+        cache_current = read_lineage_cache(args.lineage_cache)
+    cached_taxids = set(lineage_cache)
+    
     with open(multifilelist, newline = '') as multif:                                                                                          
             multi_reader = csv.reader(multif, delimiter='\t')
             SampleFuncRpkgdict = {}
+            taxaIdDict = {}
             
             for line in multi_reader:
                 print ("line:",line)
@@ -41,25 +76,22 @@ def main():
                 filename = line[1]
                 #taxid = TaxID(dbtype='sqlite', dbname='/home/dhwani/databases/taxadb.sqlite')
                 #tftype = args.taxafiletype
-                taxadict=parseKraken2Taxafile(filename)
-                
-                
-                rank_search_string = "phylum,class,order,family,genus,species"
-                prefix_dict = {
-                    "phylum": "p_",
-                    "class": "c_",
-                    "order": "o_",
-                    "family": "f_",
-                    "genus": "g_",
-                    "species": "s_"
-                    }
+                taxidcounts=countKraken2Taxids(filename)
+                print ("Distinct taxids:", len(taxidcounts))
                 
-                taxadictWlineage, taxaIdDict = get_full_lineage(taxadict, rank_search_string, prefix_dict)
-                first10pairs = {k: taxaIdDict[k] for k in list(taxaIdDict)[1:20]}
+                taxadictWlineage, sampleTaxaIdDict = get_full_lineage(taxidcounts, rank_search_string, prefix_dict)
+                taxaIdDict.update(sampleTaxaIdDict)
+                first10pairs = {k: sampleTaxaIdDict[k] for k in list(sampleTaxaIdDict)[1:20]}
                 print("resultant dictionary : \n", first10pairs)
                 
                 SampleFuncRpkgdict[sampletag] = taxadictWlineage
-                
+    
+    if (args.lineage_cache):
+        new_taxids = [id for id in lineage_cache if id not in cached_taxids]
+        if (new_taxids or not cache_current):
+            # Keep the lineages that concurrent runs have added since this one started
+            read_lineage_cache(args.lineage_cache)
+            write_lineage_cache(args.lineage_cache, lineage_cache)
                 
     pdDF = pd.DataFrame.from_dict(SampleFuncRpkgdict, orient='index')
     pdDF.fillna(0, inplace = True)
@@ -95,102 +127,151 @@ def main():
     
     #print (pdDFT.columns)
     
-    pd.DataFrame.to_csv(pdDFT_mod, path_or_buf=outfile, sep='\t', na_rep='', header=True, index=True, mode='w', line_terminator='\n', escapechar=None, decimal='.')
+    pd.DataFrame.to_csv(pdDFT_mod, path_or_buf=outfile, sep='\t', na_rep='', header=True, index=True, mode='w', lineterminator='\n', escapechar=None, decimal='.')
 
     
 
-def parseKraken2Taxafile(filename):
-    d = {}
+def countKraken2Taxids(filename):
+    # Stream a Kraken2 output file and count the classified reads per taxid
+    counts = Counter()
+    start = '(taxid '
+    end = ')'
+    
     with open(filename) as f:
         for line in f:
             fields = line.split("\t")
             classified = fields[0]
-            key = fields[1]
-            val = fields[2]    
-            #print (fields[0])
+            val = fields[2]
             if (classified == 'C'):
-                d[str(key)] = str(val)
-    return d
+                # Names are only present when Kraken2 ran with --use-names
+                if start in val:
+                    id = val[val.find(start)+len(start):val.rfind(end)]
+                else:
+                    id = val.strip()
+                counts[id] += 1
+    return counts
 
-def get_full_lineage(taxdict, rank_str, pref_dict):
-    
-    lineage_dict = defaultdict(list)
+def get_full_lineage(taxidcounts, rank_str, pref_dict):
+    # Resolve the lineage of each distinct taxid once and add up its read count
+    lineage_count_dict = defaultdict(int)
     lineage_id_dict = {}
-    lineage = ""
-    count="1"
-    
-    for k,val in taxdict.items():
-        complete_taxa_string=""
-        #s = 'asdf=5;iwantthis123jasd'
-        #tax_id = re.search('(taxid (.*))', val)
-        #print(tax_id.group(1))
-        start = '(taxid '
-        end = ')'
-        #s = 'asdf=5;iwantthis123jasd'
-        #print (val[val.find(start)+len(start):val.rfind(end)])
-        id = val[val.find(start)+len(start):val.rfind(end)]
-        #print("Tax ID is:",id)
+    
+    for id, count in taxidcounts.items():
         if (id == '0'):
             id = '1'
         
-        try:
-            lineage = ncbi.get_lineage(id)
-            #import _pickle as cPickle
-        except ValueError:
-            #print("Oops!  That was no valid number.  Try again...")
-            pass
-            #import pickle
-            
-
-        if (lineage):
-            ranks = ncbi.get_rank(lineage)
-            #print ("ranks :", ranks)
-            names = ncbi.translate_to_names(lineage)
-            #print ("names :", names)
-            
-            id_name_dict = {lineage[i]: names[i] for i in range(len(lineage))}
-            #print ("Id-name dict:", id_name_dict)
-            rank_str_list = list(rank_str.split(","))
-            newDict = {key: value for (key, value) in ranks.items() if value in rank_str_list }
-            #print ("filetered: ", newDict)
-            
-            inv_FiltDict = {v: k for k, v in newDict.items()}
-            
-            all_taxa=[]
-            
-            for tax_rank in rank_str_list:
-                tax_prefix = pref_dict[tax_rank]
-                #print ("prefix ..: ", tax_prefix)
-                
-                if (tax_rank in inv_FiltDict):
-                    rank_tax_id = inv_FiltDict[tax_rank]
-                else:
-                    rank_tax_id = 'NA'
-                
-                if (rank_tax_id in id_name_dict):
-                    rank_tax_name = id_name_dict[rank_tax_id]
-                else:
-                    rank_tax_name = 'NA'
-                
-                rank_tax_name_w_pref = tax_prefix + "_" + rank_tax_name
-                all_taxa.append(rank_tax_name_w_pref)
-                
-                #complete_taxa_string += complete_taxa_string + rank_tax_name
-                #print ("rank:\t",tax_rank)
-                #print ("name:\t",rank_tax_name)
-            complete_taxa_string = ';'.join(all_taxa)
+        complete_taxa_string = resolve_lineage(id, rank_str, pref_dict)
 
+        if (complete_taxa_string):
             #print ("Taxa string :", complete_taxa_string)
             
-            lineage_dict[complete_taxa_string].append(count)
+            lineage_count_dict[complete_taxa_string] += count
             lineage_id_dict[complete_taxa_string] = id
         else:
             print ("lineage not found, check ID:", id)
     
-    #my_dictionary = dict(map(lambda kv: (kv[0], f(kv[1])), my_dictionary.iteritems()))
+    return dict(lineage_count_dict), lineage_id_dict
+
 
-    lineage_count_dict = dict(map(lambda x: (x[0], len(x[1])), lineage_dict.items()))
-    return lineage_count_dict, lineage_id_dict
+def resolve_lineage(id, rank_str, pref_dict):
+    # 6-rank lineage string of a taxid, or None if ete3 has no lineage for it
+    if id in lineage_cache:
+        return lineage_cache[id]
     
+    lineage = ""
+    try:
+        lineage = get_ncbi().get_lineage(id)
+    except ValueError:
+        pass
+    
+    complete_taxa_string = None
+    if (lineage):
+        ranks = get_ncbi().get_rank(lineage)
+        #print ("ranks :", ranks)
+        names = get_ncbi().translate_to_names(lineage)
+        #print ("names :", names)
+        
+        id_name_dict = {lineage[i]: names[i] for i in range(len(lineage))}
+        #print ("Id-name dict:", id_name_dict)
+        rank_str_list = list(rank_str.split(","))
+        newDict = {key: value for (key, value) in ranks.items() if value in rank_str_list }
+        #print ("filetered: ", newDict)
+        
+        inv_FiltDict = {v: k for k, v in newDict.items()}
+        
+        all_taxa=[]
+        
+        for tax_rank in rank_str_list:
+            tax_prefix = pref_dict[tax_rank]
+            #print ("prefix ..: ", tax_prefix)
+            
+            if (tax_rank in inv_FiltDict):
+                rank_tax_id = inv_FiltDict[tax_rank]
+            else:
+                rank_tax_id = 'NA'
+            
+            if (rank_tax_id in id_name_dict):
+                rank_tax_name = id_name_dict[rank_tax_id]
+            else:
+                rank_tax_name = 'NA'
+            
+            rank_tax_name_w_pref = tax_prefix + "_" + rank_tax_name
+            all_taxa.append(rank_tax_name_w_pref)
+            
+        complete_taxa_string = ';'.join(all_taxa)
+    
+    lineage_cache[id] = complete_taxa_string
+    return complete_taxa_string
+
+
+def read_lineage_cache(filename):
+    # Load a taxid<TAB>lineage table written by write_lineage_cache. Returns
+    # False, loading nothing, if the file is missing or its header names
+    # another taxonomy database (or the same file since rebuilt). Lines that are
+    # not a taxid and a complete 6-rank lineage are skipped.
+    skipped = 0
+    try:
+        with open(filename) as f:
+            header = f.readline().rstrip('\n').split("\t")
+            if (header != ['#taxdb'] + taxonomy_db_version()):
+                print ("Lineage cache", filename, "was not built from this taxonomy database (" + ' '.join(header[1:]) + "), it will be rebuilt")
+                return False
+            for line in f:
+                fields = line.rstrip('\n').split("\t")
+                if (not line.endswith('\n') or len(fields) != 2 or fields[1].count(';') != len(prefix_dict) - 1):
+                    skipped += 1
+                    continue
+                lineage_cache[fields[0]] = fields[1]
+    except FileNotFoundError:
+        print ("Lineage cache not found, it will be created:", filename)
+        return False
+    if skipped:
+        print ("Skipped malformed lines in lineage cache:", skipped)
+    print ("Lineages in cache:", len(lineage_cache))
+    return True
+
+
+def write_lineage_cache(filename, lineages):
+    # Unresolved taxids are not written, so they are retried on the next run.
+    # The file starts with the taxonomy database the lineages came from. It is
+    # written next to the cache and moved over it, so runs reading the cache at
+    # the same time never see a partly written file.
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix=os.path.basename(filename) + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write('\t'.join(['#taxdb'] + taxonomy_db_version()) + "\n")
+            for id, lineage in lineages.items():
+                if (lineage):
+                    f.write(id + "\t" + lineage + "\n")
+        # mkstemp creates the file for its owner only
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpname, 0o666 & ~umask)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+
+
 if __name__ == "__main__":
     main();
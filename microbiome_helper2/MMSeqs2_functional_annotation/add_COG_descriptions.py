@@ -5,14 +5,16 @@ Created on Wed Mar 18 21:41:11 2020
 
 @author: Dhwani
 """
-# import numpy as np
-# import pandas as pd
+import numpy as np
+import pandas as pd
 import csv
 from collections import defaultdict
 # import _pickle as cPickle
 # import bz2
 from operator import itemgetter
+from itertools import islice
 import re
+import mmap
 
 import argparse, sys, textwrap
 
@@ -23,6 +25,18 @@ parser.add_argument('--protIdfile', help = 'COG file mapping acc to GI')
 parser.add_argument('--Cogfile', help = 'COG DB csv File')
 parser.add_argument('--CogNamesfile', help = 'COG file mapping COD Ids to names')
 parser.add_argument('--outfilename', help = 'Output file name with added descriptions')
+parser.add_argument('--build_index', help = textwrap.dedent('''Write a compiled index resolving every accession of --protIdfile straight to its
+    protID-cogID-cogname label (using --Cogfile and --CogNamesfile) to this file; annotates --rpkfile too if given
+    '''))
+parser.add_argument('--index', help = 'Compiled index written by --build_index; replaces --protIdfile, --Cogfile and --CogNamesfile')
+parser.add_argument('--columnar', action = 'store_true', help = 'Annotate the RPK table in chunks of rows with vectorized pandas string operations instead of line by line (same output)')
+parser.add_argument('--chunksize', type = int, default = 100000, help = 'Rows per chunk with --columnar (default: 100000)')
+
+# Runs of tabs separate the columns of the RPK table
+tab_runs = re.compile(r'\t+')
+
+# First line of a compiled index; the label for accessions missing from it follows the tab
+index_header = '#COGINDEX'
 
 
 def main():
@@ -31,70 +45,152 @@ def main():
     rpkfilename = args.rpkfile
     outp = args.outfilename
     
+    if (args.index):
+        cogLabel = COGIndex(args.index).get
+    else:
+        protIdfilename = args.protIdfile
+        
+        cogfilename = args.Cogfile
+        
+        cognamesfilename = args.CogNamesfile
+        
+        cogProtIdhash = parseProtIds(protIdfilename)
+        
+        cognameshash = parseCognames(cognamesfilename)
+        
+        cogDBhash = parseCOGDB(cogfilename)
+        
+        cogLabel = cogLabelResolver(cogProtIdhash,cogDBhash,cognameshash)
+        
+        if (args.build_index):
+            writeCOGIndex(args.build_index,cogProtIdhash,cogLabel)
+            print ("Wrote COG index to " + args.build_index)
+            if not rpkfilename:
+                return
     
-    protIdfilename = args.protIdfile
-    
-    cogfilename = args.Cogfile
-    
-    cognamesfilename = args.CogNamesfile
-    
-    cogProtIdhash = parseProtIds(protIdfilename)
-    
-    #first10pairs = {k: cogProtIdhash[k] for k in list(cogProtIdhash)[10:20]}
-    #print("resultant dictionary : \n", first10pairs) 
-    
-    cognameshash = parseCognames(cognamesfilename)
-    
-    cogDBhash = parseCOGDB(cogfilename)
+    # Stratified tables repeat each function once per taxon, so every
+    # accession is resolved only once per run
+    memo = {}
     
     ofh = open(outp, "w+")
-    default = ""
     with open(rpkfilename , 'r') as rpkf:
         first_line = rpkf.readline()
         ofh.write(first_line)
-        for line in rpkf:
-            fields = re.split(r'\t+', line.rstrip('\n'))
-            full_id = fields[0]
-            #print(id)
-            m = bool(re.search("\|", full_id))
-            # print (str(m))
-            if m:
-                # print("found stratified file ...")
-                parts = re.split("\|", full_id)
-                id = parts[0]
-                tax = parts[1]
-                id = re.sub('\..*', '', id)
-                # print (len(parts),tax)
-                protID = cogProtIdhash.get(id, default)
-                # print (protID)
-                cogID = cogDBhash.get(protID,default)
-                cogname = cognameshash.get(str(cogID),default)
-                # print (cogname)
-                lst_to_print = (protID,cogID,cogname)
-                newID = ('-'.join(lst_to_print))
-                newID = newID + "|" + str(tax)
-                # print (newID)
+        if (args.columnar):
+            annotateColumnar(rpkf,ofh,cogLabel,memo,args.chunksize)
+        else:
+            for line in rpkf:
+                fields = tab_runs.split(line.rstrip('\n'))
+                full_id = fields[0]
+                id, stratified, tax = full_id.partition('|')
+                id = id.partition('.')[0]
+                
+                newID = memo.get(id)
+                if newID is None:
+                    newID = memo[id] = cogLabel(id)
+                if stratified:
+                    newID = newID + "|" + tax.partition('|')[0]
+                
+                fields[0] = newID
+                
+                lst_to_print_final = ('\t'.join(fields))
+                ofh.write(lst_to_print_final + '\n')
+    ofh.close()
+
+
+def annotateColumnar(rpkf,ofh,cogLabel,memo,chunksize):
+    # Same rewriting as the line loop in main, on a whole chunk of lines at a
+    # time: the accession and the "|taxon" part of the first column are cut out
+    # with regular expressions over the chunk, and each distinct accession of a
+    # chunk is looked up once
+    while True:
+        lines = pd.Series(list(islice(rpkf, chunksize)), dtype=str)
+        if lines.empty:
+            return
+        
+        lines = lines.str.rstrip('\n')
+        collapse = lines.str.contains(r'\t\t', regex=True)
+        if collapse.any():
+            lines[collapse] = lines[collapse].str.replace(r'\t+', '\t', regex=True)
+        
+        ids = lines.str.extract(r'^([^\t|.]*)', expand=False).astype('category')
+        # "|taxon" (only the first one) if the function is stratified, then the other columns
+        tails = lines.str.replace(r'^[^\t|]*(\|[^\t|]*)?[^\t]*', r'\1', regex=True)
+        
+        labels = []
+        for id in ids.cat.categories:
+            newID = memo.get(id)
+            if newID is None:
+                newID = memo[id] = cogLabel(id)
+            labels.append(newID)
+        newIDs = pd.Series(np.array(labels, dtype=object)[ids.cat.codes.to_numpy()], index=lines.index, dtype=str)
+        
+        ofh.write((newIDs + tails).str.cat(sep='\n') + '\n')
+
+
+def cogLabelResolver(cogProtIdhash,cogDBhash,cognameshash):
+    # protID-cogID-cogname label of an accession (without version), through the parsed tables
+    default = ""
+    
+    def cogLabel(id):
+        protID = cogProtIdhash.get(id, default)
+        cogID = cogDBhash.get(protID,default)
+        cogname = cognameshash.get(str(cogID),default)
+        lst_to_print = (protID,cogID,cogname)
+        return '-'.join(lst_to_print)
     
+    return cogLabel
+
+
+def writeCOGIndex(filename,cogProtIdhash,cogLabel):
+    # One "accession<TAB>label" line per accession, sorted by accession so that
+    # COGIndex can binary search the file; the header holds the label of
+    # accessions that are not in the protein ID file
+    missing = '\n'
+    while missing in cogProtIdhash:
+        missing += '\n'
+    
+    with open(filename, 'w') as f:
+        f.write(index_header + '\t' + cogLabel(missing) + '\n')
+        for acc in sorted(cogProtIdhash):
+            f.write(acc + '\t' + cogLabel(acc) + '\n')
+
+
+class COGIndex:
+    # Memory-mapped view of a --build_index file; lookups binary search the
+    # sorted lines, so nothing is parsed up front
+    
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_end = self.mm.find(b'\n')
+        header = self.mm[:header_end].decode()
+        if not header.startswith(index_header + '\t'):
+            sys.exit(filename + ' is not a COG index written by --build_index')
+        self.missing = header[len(index_header) + 1:]
+        self.start = header_end + 1
+    
+    def get(self, id):
+        key = id.encode()
+        lo, hi = self.start, len(self.mm)
+        # lo always sits at the start of a line
+        while lo < hi:
+            mid = (lo + hi) // 2
+            line_start = self.mm.rfind(b'\n', lo, mid) + 1 or lo
+            line_end = self.mm.find(b'\n', line_start)
+            if (line_end < 0):
+                line_end = len(self.mm)
+            tab = self.mm.find(b'\t', line_start, line_end)
+            acc = self.mm[line_start:tab]
+            if (acc < key):
+                lo = line_end + 1
+            elif (acc > key):
+                hi = line_start
             else:
-                # print ("found unstr")
-                id = full_id
-                id = re.sub('\..*', '', id)
-                # print (len(parts),tax)
-                protID = cogProtIdhash.get(id, default)
-                # print (protID)
-                cogID = cogDBhash.get(protID,default)
-                cogname = cognameshash.get(str(cogID),default)
-                # print (cogname)
-                lst_to_print = (protID,cogID,cogname)
-                newID = ('-'.join(lst_to_print))
-                # newID = newID + "|" + str(tax)
-                # print (newID)
-            
-            fields[0] = newID
-            
-            lst_to_print_final = ('\t'.join(fields))
-            # print (lst_to_print_final)
-            ofh.write(lst_to_print_final + '\n')
+                return self.mm[tab + 1:line_end].decode()
+        return self.missing
+
+
 def parseCOGDB(filename):
     d = defaultdict(list)
     print ("In COG DB parse ... ")
@@ -1,32 +1,80 @@
-# Create a simple dataframe 
-  
-# importing pandas as pd 
-import pandas as pd 
+# Convert PICRUSt2 stratified tables (pathway and sequence columns) into the
+# stratified format used here (a single pathway|sequence function column)
+
 import argparse, sys, textwrap
+import glob, gzip, os
 
 parser=argparse.ArgumentParser()
-parser.add_argument('--filename', help = 'picrust2 output')
+parser.add_argument('--filename', help = 'picrust2 output (may be gzipped)')
 parser.add_argument('--outfilename', help = 'Output filename to store stratified output')
+parser.add_argument('--indir', help = 'Convert every PICRUSt2 output in this directory matching --pattern instead of a single --filename')
+parser.add_argument('--outdir', help = textwrap.dedent('''Directory to write the converted --indir files to, as <name>_stratified.tsv
+    (gzipped again if the input was)
+    '''))
+parser.add_argument('--pattern', default = '*.tsv*', help = 'Files of --indir to convert (default: *.tsv*)')
 
 def main():
-    # creating a dataframe
     args = parser.parse_args()
-    fileN = args.filename
-    outputfileN = args.outfilename
-    
-    #df = pd.read_table(file, sep='\t', header=0, index_col=0, lineterminator='\n')
-    df = pd.read_csv(fileN, sep = '\t')
-    print (df.head())
-    #df[['function','sequence']] = df.function.str.split("|",expand=True)
-    #df = df[ ['taxon'] + [ col for col in df.columns if col != 'taxon' ] ]
-    df['function'] = df['pathway'].str.cat(df['sequence'], sep ="|")
-    df.drop(['pathway','sequence'], axis = 1, inplace = True)
-    cols = df.columns.tolist()
-    cols.insert(0, cols.pop(cols.index('function')))
-    df = df.reindex(columns= cols)
-    print (df.head())
-    
-    pd.DataFrame.to_csv(df, path_or_buf=outputfileN, sep='\t', na_rep='', header=True, index=False, mode='w', line_terminator='\n', escapechar=None, decimal='.')
-    
+
+    if (args.indir):
+        if not args.outdir:
+            sys.exit('--outdir is required with --indir')
+        os.makedirs(args.outdir, exist_ok=True)
+
+        for fileN in sorted(glob.glob(os.path.join(args.indir, args.pattern))):
+            name = os.path.basename(fileN)
+            gzipped = name.endswith('.gz')
+            for ext in ('.gz', '.tsv'):
+                if name.endswith(ext):
+                    name = name[:-len(ext)]
+            # outputs of an earlier run (e.g. with --outdir the same as --indir)
+            if name.endswith('_stratified'):
+                continue
+            outputfileN = os.path.join(args.outdir, name + '_stratified.tsv' + ('.gz' if gzipped else ''))
+            # PICRUSt2 writes unstratified tables next to the stratified ones
+            if not convert(fileN, outputfileN):
+                print ("Skipping", fileN + ": no pathway and sequence columns")
+                continue
+            print (fileN, '->', outputfileN)
+    else:
+        if not convert(args.filename, args.outfilename):
+            sys.exit(args.filename + ' has no pathway and sequence columns')
+
+
+def convert(fileN, outputfileN):
+    # Rewrite one table line by line: the pathway and sequence columns are
+    # replaced by a leading function column holding pathway|sequence and all
+    # other columns are copied through as they are. Returns False, without
+    # creating the output, if the table has no pathway and sequence columns
+    with openTable(fileN, 'r') as inf:
+        header = inf.readline().rstrip('\n').split('\t')
+        if ('pathway' not in header or 'sequence' not in header):
+            return False
+        pathway_i = header.index('pathway')
+        sequence_i = header.index('sequence')
+        other_i = [i for i in range(len(header)) if i not in (pathway_i, sequence_i)]
+
+        with openTable(outputfileN, 'w') as outf:
+            outf.write('\t'.join(['function'] + [header[i] for i in other_i]) + '\n')
+
+            for line in inf:
+                fields = line.rstrip('\n').split('\t')
+                pathway = fields[pathway_i]
+                sequence = fields[sequence_i]
+                # a missing pathway or sequence leaves the function empty
+                if (pathway and sequence):
+                    function = pathway + '|' + sequence
+                else:
+                    function = ''
+                outf.write('\t'.join([function] + [fields[i] for i in other_i]) + '\n')
+
+    return True
+
+
+def openTable(fileN, mode):
+    if fileN.endswith('.gz'):
+        return gzip.open(fileN, mode + 't', newline='')
+    return open(fileN, mode, newline='')
+
 if __name__ == "__main__":
         main();
@@ -6,10 +6,12 @@ import numpy as np
 import pandas as pd
 
 #from taxadb.taxid import TaxID
-from ete3 import NCBITaxa
 from ete3 import PhyloTree
 #from ete3 import NCBITaxa
-ncbi = NCBITaxa()
+from ncbi_taxdb import add_taxdb_arguments, set_taxonomy_db, get_ncbi, build_taxonomy_db
+
+# taxid -> 6-rank lineage string, so each taxid is resolved only once
+lineage_cache = {}
 
 parser=argparse.ArgumentParser()
 
@@ -17,9 +19,21 @@ parser.add_argument('--StratFileName', help = 'filename of file containing the s
 #parser.add_argument('--filetype', help = 'type of files to parse, either of kraken2 OR stratified')
 parser.add_argument('--taxaAbundFile', help = 'The krkaken2 taxa abundance file generated with 6 levels of taxonomy')
 parser.add_argument('--outfile', help = 'File to write the taxonomy count matrix')
+parser.add_argument('--chunksize', type = int, default = 10000, help = 'Number of rows of the stratified file converted and written at a time, bounding memory use (default: 10000)')
+parser.add_argument('--skip_zero', action = 'store_true', help = 'Leave out rows with a zero contribution')
+parser.add_argument('--format', default = 'tsv', choices = ['tsv', 'parquet', 'feather'], help = 'Output format; parquet and feather need pyarrow (default: tsv)')
+
+add_taxdb_arguments(parser)
 
 def main():
     args = parser.parse_args()
+    
+    set_taxonomy_db(args.taxdb, args.update_taxonomy)
+    
+    if (args.build_taxdb):
+        build_taxonomy_db(args.taxdb, args.taxdump)
+        return
+    
     filename = args.StratFileName
     #filetype = args.filetype
     taxafile = args.taxaAbundFile
@@ -94,139 +108,123 @@ def main():
         #pd.DataFrame.to_csv(pdDFT_mod, path_or_buf=outfile, sep='\t', na_rep='', header=True, index=True, mode='w', line_terminator='\n', escapechar=None, decimal='.')
 
     #elif (filetype == 'stratified'):
-    keyStrDict = {}
-    idFulltaxaDict = {}
-    lineage_otuidDict = {}
-    genecopynoDict = {}
-    
     #filename = multifilelist
     
-    DF = pd.read_table(filename, index_col=0)
-    
-    taxaAbundDF = parseTaxaAbundancefile(taxafile)
-    
-    #idFulltaxaDict = pd.Series(taxaAbundDF.Letter.values,index=df.Position).to_dict()
-    idFulltaxaDict = dict(zip(taxaAbundDF['index'], list(taxaAbundDF.index)))
+    idFulltaxaDict = parseTaxaAbundancefile(taxafile)
     
     first10pairs = {k: idFulltaxaDict[k] for k in list(idFulltaxaDict)[1:20]}
     print("otu id - lineage dict dictionary : \n", first10pairs)
-    #print ("element of taxaDF: ", taxaAbundDF.at["6_6072","BB16-15D-2_mmseqs"])
-    #print ("indexex of taxaDf: ", list(taxaAbundDF.index.values))
     
-    
-
-    f = open(filename, "r")
-    first_line = f.readline().strip('\n')
-    for line in f:
-        fields = line.split("\t")
-        FuncTaxastr = fields[0]
-        FuncTaxa = FuncTaxastr.split("|")
-        func = FuncTaxa[0]
-        TaxaStr = FuncTaxa[1]
+    rank_search_string = "phylum,class,order,family,genus,species"
+    prefix_dict = {
+                "phylum": "p_",
+                "class": "c_",
+                "order": "o_",
+                "family": "f_",
+                "genus": "g_",
+                "species": "s_"
+                }
+    
+    # Convert and write the stratified table one block of rows at a time, so
+    # memory does not grow with the number of functions x samples
+    writer = LongFormatWriter(outfile, args.format)
+    missing_otus = set()
+    
+    # pandas infers the column types per block (int64 for a block of whole
+    # numbers), so they are fixed up front: samples are float64 throughout
+    columns = pd.read_table(filename, nrows=0).columns
+    dtypes = dict.fromkeys(columns[1:], 'float64')
+    dtypes[columns[0]] = str
+    
+    for DF in pd.read_table(filename, index_col=0, chunksize=args.chunksize, dtype=dtypes):
+        DF_long, lineages = melt_stratified_chunk(DF, rank_search_string, prefix_dict)
+        missing_otus.update(lineage for lineage in lineages if lineage not in idFulltaxaDict)
         
-        start = '(taxid '
-        end = ')'
-        #s = 'asdf=5;iwantthis123jasd'
-        #print (val[val.find(start)+len(start):val.rfind(end)])
-        id = TaxaStr[TaxaStr.find(start)+len(start):TaxaStr.rfind(end)]
-        if (id == '0'):
-            id = '1'
-        
-        rank_search_string = "phylum,class,order,family,genus,species"
-        prefix_dict = {
-                    "phylum": "p_",
-                    "class": "c_",
-                    "order": "o_",
-                    "family": "f_",
-                    "genus": "g_",
-                    "species": "s_"
-                    }
-        #print ("Function\tTaxa\tTaxid", func,TaxaStr,id)
-        replacementStr_compLineage = get_full_lineage_for_id(id,rank_search_string,prefix_dict)
-        #print ("Replacement string :", replacementStr_compLineage)
-        newFuncTaxaStr = func+"|"+replacementStr_compLineage
-        #print ("new fucn taxa : ", newFuncTaxaStr)
-        keyStrDict[FuncTaxastr] = newFuncTaxaStr
-    
-    first10pairs = {k: keyStrDict[k] for k in list(keyStrDict)[1:20]}
-    print("orig id  - lineage dictionary : \n", first10pairs)
-    #lineageOtuId_dict = {value: key for key, value in .items()}
-    #Insert the new key string into df and remove the old key string
-    
-    for orig_id,new_id in keyStrDict.items():
-        func_taxa = new_id.split("|")
-        lineage_str = func_taxa[1]
-        #otu_id = idFulltaxaDict[lineage_str]
-        otu_id = idFulltaxaDict.get(lineage_str)
-        if otu_id:
-            lineage_otuidDict[orig_id] = otu_id
-            genecopynoDict[orig_id] = 1.0
-        else:
-            print ("Damn OTU id not found")
+        if (args.skip_zero):
+            DF_long = DF_long[DF_long["Contribution"] != 0]
         
+        writer.write(DF_long)
     
-    first10pairs = {k: lineage_otuidDict[k] for k in list(lineage_otuidDict)[1:20]}
-    print("orig id  - lineage dictionary : \n", first10pairs)
-
+    writer.close()
+    print("Distinct taxids resolved: ", len(lineage_cache))
+    
+    if missing_otus:
+        print ("OTU id not found for lineages: ", sorted(missing_otus))
 
-            #d2[key] = d1[key]
 
-    DF["newID"] = pd.Series(keyStrDict)
-    #DF["OTU"] = pd.Series(lineage_otuidDict)
-    #DF["GeneCountPerGenome"] = pd.Series(genecopynoDict)
+def melt_stratified_chunk(DF, rank_str, pref_dict):
+    # Long (Sample, Genus, Gene, Contribution) rows for a block of the
+    # stratified table, together with the lineages seen in the block
     
-    col_name="newID"
-    first_col = DF.pop(col_name)
-    #DF=DF.reset_index()
+    # Split "function|taxon (taxid N)" and resolve every distinct taxid only
+    # once; the lineages are then spread over the rows through a categorical
+    FuncTaxa = DF.index.to_series().str.split("|")
+    taxids = FuncTaxa.str[1].str.extract(r'\(taxid (.*)\)', expand=False).replace('0', '1').astype('category')
     
-    #print ("new id column :\n", first_col)
+    lineages = {id: get_full_lineage_for_id(id,rank_str,pref_dict) for id in taxids.cat.categories}
     
-    
-    DF.insert(0, col_name, first_col)
-    
-    #DF_mod.set_index(col_name, inplace=True)
-    #DF_mod.columns.name = col_name
-    DF=DF.reset_index()
-    DF = DF.drop('function', 1)
-    
-    #split first column into "function" and "taxa"
-    
-    DF[['Gene','Genus']] = DF['newID'].str.split('|',expand=True)
-    DF = DF.drop('newID', 1)
+    DF = DF.reset_index(drop=True)
+    DF.insert(0, 'Genus', taxids.map(lineages).to_numpy())
+    DF.insert(0, 'Gene', FuncTaxa.str[0].astype('category').to_numpy())
     
     # rearrange format by melting sample and taxa
-    #stubnames = sorted(set([match[0] for match in DF.columns.str.findall(r'[B]\(.*\)').values if match != []]))
-    #l = pd.wide_to_long(DF, stubnames='contributions', i=['famid', 'birth'], j='age')
-    #print ("Stubnames: ", stubnames)
-    
     DF_long = DF.melt(id_vars=["Gene", "Genus"], var_name = "Sample", value_name = "Contribution")
-#        DF_long2 = DF.melt(id_vars=["Gene", "Genus"], var_name = "OTU", value_name = "OTU")
-    
     
     cols = DF_long.columns.tolist()
     cols[0],cols[2] = cols[2],cols[0]
-    print("Final Columns of DF:", cols)
-    
-    DF_long = DF_long[cols]
     
-    #DF_long[~DF_long.Sample.str.contains("OTU", na=False)]
+    return DF_long[cols], set(lineages.values())
+
+
+class LongFormatWriter:
+    # Appends blocks of long-format rows to a TSV, Parquet or Feather file
+    
+    def __init__(self, outfile, fmt):
+        self.outfile = outfile
+        self.fmt = fmt
+        self.arrow_writer = None
+        self.header = True
+        
+        if (fmt != 'tsv'):
+            try:
+                import pyarrow
+            except ImportError:
+                sys.exit('pyarrow is needed for --format ' + fmt)
+    
+    def write(self, DF_long):
+        if (self.fmt == 'tsv'):
+            pd.DataFrame.to_csv(DF_long, path_or_buf=self.outfile, sep='\t', na_rep='', header=self.header, index=False, mode='w' if self.header else 'a', lineterminator='\n', escapechar=None, decimal='.')
+            self.header = False
+            return
+        
+        import pyarrow as pa
+        
+        # Categories differ between blocks, so the labels are written as plain
+        # strings. The schema is fixed rather than inferred from the first block,
+        # where e.g. a Genus column with no resolved lineage would have no type.
+        DF_long = DF_long.astype({'Sample': object, 'Genus': object, 'Gene': object})
+        
+        if self.arrow_writer is None:
+            self.schema = pa.schema([(name, pa.float64() if name == 'Contribution' else pa.string()) for name in DF_long.columns])
+            if (self.fmt == 'parquet'):
+                import pyarrow.parquet as pq
+                self.arrow_writer = pq.ParquetWriter(self.outfile, self.schema)
+            else:
+                self.arrow_writer = pa.ipc.new_file(self.outfile, self.schema)
+        
+        self.arrow_writer.write_table(pa.Table.from_pandas(DF_long, schema=self.schema, preserve_index=False))
     
-    pd.DataFrame.to_csv(DF_long, path_or_buf=outfile, sep='\t', na_rep='', header=True, index=False, mode='w', line_terminator='\n', escapechar=None, decimal='.')
+    def close(self):
+        if self.arrow_writer is not None:
+            self.arrow_writer.close()
+
 
 def parseTaxaAbundancefile(taxaabundfile):
-    taxDF = {}
-    taxDF = pd.read_table(taxaabundfile, index_col = 'newID', header = 0)
-    cols = taxDF.columns.tolist()
-    print ("tax DF columns :", cols)
-    #taxDF_long = taxDF.melt(id_vars=['newID', "index"], var_name="Sample", value_name="Abund")
-    pd.DataFrame.to_csv(taxDF, path_or_buf='taxtest.out', sep='\t', na_rep='', header=True, index=True, mode='w', line_terminator='\n', escapechar=None, decimal='.')
-    #taxDF = taxDF.reset_index
-    #taxDF.set_index([taxDF.iloc[0], taxDF.columns[0]])
-    #taxDF.set_index(list(taxDF)[0])
-    #taxDF.set_index(taxDF.iloc[0].values)
-    return taxDF
-    #pd.DataFrame.to_csv(taxDF_long, path_or_buf='taxtest.out', sep='\t', na_rep='', header=True, index=False, mode='w', line_terminator='\n', escapechar=None, decimal='.')
-    #return taxDF_long
+    # Map each lineage ("index" column) of the 6-level taxa abundance table to
+    # its OTU id ("newID" column); the sample columns are not read
+    taxDF = pd.read_table(taxaabundfile, usecols = ['newID', 'index'], dtype = str, header = 0)
+    print ("Lineages in taxa abundance file :", len(taxDF))
+    return dict(zip(taxDF['index'], taxDF['newID']))
 
 
 
@@ -245,17 +243,20 @@ def parseKraken2Taxafile(filename):
     return d
 
 def get_full_lineage_for_id(idStr, rank_str, pref_dict):
+    if idStr in lineage_cache:
+        return lineage_cache[idStr]
+    
     lineage = ""
     try:
-        lineage = ncbi.get_lineage(idStr)
+        lineage = get_ncbi().get_lineage(idStr)
             #import _pickle as cPickle
     except ValueError:
         print("Oops!  That was no valid number.  Try again...", idStr)
         pass
     
-    ranks = ncbi.get_rank(lineage)
+    ranks = get_ncbi().get_rank(lineage)
     #print ("ranks :", ranks)
-    names = ncbi.translate_to_names(lineage)
+    names = get_ncbi().translate_to_names(lineage)
     #print ("names :", names)
     
     id_name_dict = {lineage[i]: names[i] for i in range(len(lineage))}
@@ -289,6 +290,7 @@ def get_full_lineage_for_id(idStr, rank_str, pref_dict):
         #print ("rank:\t",tax_rank)
         #print ("name:\t",rank_tax_name)
     complete_taxa_string = ';'.join(all_taxa)
+    lineage_cache[idStr] = complete_taxa_string
     return complete_taxa_string
     
 
@@ -314,16 +316,16 @@ def get_full_lineage(taxdict, rank_str, pref_dict):
             id = '1'
         
         try:
-            lineage = ncbi.get_lineage(id)
+            lineage = get_ncbi().get_lineage(id)
             #import _pickle as cPickle
         except ValueError:
             print("Oops!  That was no valid number.  Try again...")
             pass
             #import pickle
             
-        ranks = ncbi.get_rank(lineage)
+        ranks = get_ncbi().get_rank(lineage)
         #print ("ranks :", ranks)
-        names = ncbi.translate_to_names(lineage)
+        names = get_ncbi().translate_to_names(lineage)
         #print ("names :", names)
         
         id_name_dict = {lineage[i]: names[i] for i in range(len(lineage))}
@@ -367,6 +369,7 @@ def get_full_lineage(taxdict, rank_str, pref_dict):
 
     lineage_count_dict = dict(map(lambda x: (x[0], len(x[1])), lineage_dict.items()))
     return lineage_count_dict, lineage_id_dict
-    
+
+
 if __name__ == "__main__":
     main();
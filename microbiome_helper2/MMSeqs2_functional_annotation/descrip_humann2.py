@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
+import gzip
 import pandas as pd
 import sys
 
@@ -52,9 +53,21 @@ parser.add_argument('--missing_taxon', metavar='STRING', type=str,
                     help='String to fill in for stratified tables when no '
                          'taxon string is present.')
 
+parser.add_argument('--chunksize', metavar='INT', type=int, default=None,
+                    help='Stream the input table through in blocks of this '
+                         'many rows instead of loading it all at once, '
+                         'appending each annotated block to the output. '
+                         'Abundances are then copied through as they are '
+                         'written in the input.')
+
 def main():
 
     args = parser.parse_args()
+
+    if args.chunksize:
+        describe_chunked(args)
+        return
+
     function_tab = pd.read_csv(args.input, sep="\t", low_memory=False,
                                dtype={'function': str})
 
@@ -82,18 +95,19 @@ def main():
 
         function_info["function"] = first_col
 
-    # Reindex mapfile to match order of functions in function table (and for
-    # ids to be duplicated if the table is stratified.
-    map_tab = map_tab.reindex(function_info.function,
-                              fill_value=args.missing_descrip)
+    # Look descriptions up once per distinct function id; stratified tables
+    # repeat each id once per taxon.
+    codes, unique_functions, unique_descrip = function_descriptions(
+        function_info["function"], map_tab["description"], args.missing_descrip)
 
-    function_info["description"] = list(map_tab["description"])
+    function_info["description"] = unique_descrip[codes]
 
     if args.add == "existing":
+        described = (unique_functions + ':' + unique_descrip).to_numpy()[codes]
         if strat_check:
-            function_tab.iloc[: , 0] = function_info['function'] + ':' + function_info['description'] + '|' + function_info['taxon']
+            function_tab.iloc[: , 0] = described + '|' + function_info['taxon']
         else:
-            function_tab.iloc[: , 0] = function_info['function'] + ':' + function_info['description']
+            function_tab.iloc[: , 0] = described
     elif args.add == "new":
         function_tab.drop(function_tab.columns[0], axis=1, inplace=True)
 
@@ -102,5 +116,81 @@ def main():
     function_tab.to_csv(path_or_buf=args.output, sep="\t",
                         index=False, compression="infer")
 
+def describe_chunked(args):
+    # Same annotation as main, one block of rows at a time. The map is loaded
+    # (and its index hashed) once and a first pass over the first column
+    # decides whether the table is stratified, so that every block gets the
+    # same columns.
+
+    map_tab = pd.read_csv(args.map, sep="\t", index_col=0, header=None,
+                          names=["function", "description"],
+                          low_memory=False, dtype=object)
+    descriptions = map_tab["description"]
+
+    strat_check = False
+    for first_col in pd.read_csv(args.input, sep="\t", usecols=[0], dtype=str,
+                                 chunksize=args.chunksize):
+        if first_col.iloc[: , 0].str.contains(pat="|", regex=False).any():
+            strat_check = True
+            break
+
+    if args.output.endswith(".gz"):
+        outfile = gzip.open(args.output, "wt", newline="")
+    else:
+        outfile = open(args.output, "w", newline="")
+
+    with outfile:
+        for block_i, function_tab in enumerate(pd.read_csv(args.input, sep="\t", dtype=str,
+                                                           chunksize=args.chunksize)):
+            function_tab = describe_block(function_tab, descriptions, strat_check, args)
+            function_tab.to_csv(path_or_buf=outfile, sep="\t", index=False,
+                                header=(block_i == 0))
+
+
+def describe_block(function_tab, descriptions, strat_check, args):
+    # Annotate one block of the function table with the descriptions Series
+
+    first_col = function_tab.iloc[: , 0]
+
+    if strat_check:
+        function_info = first_col.str.split('|', n=1, expand=True).reindex(columns=[0, 1])
+        function_info.columns = ['function', 'taxon']
+        function_info.insert(1, 'description', None)
+
+        function_info.loc[function_info['taxon'].isnull(), 'taxon'] = args.missing_taxon
+
+    else:
+        function_info = pd.DataFrame({'function': first_col, 'description': None})
+
+    codes, unique_functions, unique_descrip = function_descriptions(
+        function_info["function"], descriptions, args.missing_descrip)
+
+    function_info["description"] = unique_descrip[codes]
+
+    if args.add == "existing":
+        described = (unique_functions + ':' + unique_descrip).to_numpy()[codes]
+        if strat_check:
+            function_tab.iloc[: , 0] = described + '|' + function_info['taxon']
+        else:
+            function_tab.iloc[: , 0] = described
+    elif args.add == "new":
+        function_tab = function_tab.drop(function_tab.columns[0], axis=1)
+
+        function_tab = pd.concat([function_info, function_tab], sort=False, axis=1)
+
+    return function_tab
+
+def function_descriptions(functions, descriptions, missing_descrip):
+    # Factorize the function ids and reindex the descriptions on the distinct
+    # ids only. Returns the code of each row, the distinct ids and their
+    # descriptions; rows pick theirs up with unique_descrip[codes], which
+    # shares the description strings instead of copying them per row.
+
+    codes, unique_functions = pd.factorize(functions, use_na_sentinel=False)
+    unique_descrip = descriptions.reindex(unique_functions,
+                                          fill_value=missing_descrip)
+
+    return codes, unique_functions, unique_descrip.to_numpy()
+
 if __name__ == "__main__":
     main()
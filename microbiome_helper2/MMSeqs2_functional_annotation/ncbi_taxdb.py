@@ -0,0 +1,59 @@
+# ete3 NCBI taxonomy database handling shared by add_6levelsTaxonomy_to_Kraken2Results.py
+# and convert_stratifiedRpkm_to_SankeyFormat.py
+
+import os, sys
+
+from ete3 import NCBITaxa
+
+# Opened by get_ncbi() the first time a lineage has to be looked up
+ncbi = None
+taxonomy_db = {'dbfile': None, 'update': False}
+
+
+def add_taxdb_arguments(parser):
+    parser.add_argument('--taxdb', help = 'ete3 taxonomy SQLite snapshot to use (e.g. taxa-2024-01-31.sqlite, built once with --build_taxdb); defaults to the ete3 database in ~/.etetoolkit')
+    parser.add_argument('--build_taxdb', action = 'store_true', help = 'Build the --taxdb snapshot from --taxdump (or from a fresh NCBI download if --taxdump is not given) and exit')
+    parser.add_argument('--taxdump', help = 'NCBI taxdump.tar.gz to build --taxdb from')
+    parser.add_argument('--update_taxonomy', action = 'store_true', help = 'Re-download and rebuild the NCBI taxonomy database before use (not done by default)')
+
+
+def set_taxonomy_db(dbfile, update):
+    taxonomy_db['dbfile'] = dbfile
+    taxonomy_db['update'] = update
+
+
+def get_ncbi():
+    # Open the taxonomy database lazily, so runs that never need a lineage do
+    # not touch it
+    global ncbi
+    if ncbi is None:
+        if (taxonomy_db['dbfile'] and not os.path.exists(taxonomy_db['dbfile'])):
+            sys.exit('Taxonomy database ' + taxonomy_db['dbfile'] + ' not found; build it first with --build_taxdb')
+        ncbi = NCBITaxa(dbfile=taxonomy_db['dbfile'])
+        if (taxonomy_db['update']):
+            ncbi.update_taxonomy_database()
+    return ncbi
+
+
+def taxonomy_db_version():
+    # Absolute path, size and modification time of the database in use,
+    # written next to anything derived from it (the default is ete3's own
+    # ~/.etetoolkit/taxa.sqlite); the size and time are empty if it does not
+    # exist yet
+    dbfile = taxonomy_db['dbfile'] or os.path.join(os.environ.get('HOME', '/'), '.etetoolkit', 'taxa.sqlite')
+    dbfile = os.path.abspath(dbfile)
+    if not os.path.exists(dbfile):
+        return [dbfile, '', '']
+    stat = os.stat(dbfile)
+    return [dbfile, str(stat.st_size), str(int(stat.st_mtime))]
+
+
+def build_taxonomy_db(dbfile, taxdump):
+    if not dbfile:
+        sys.exit('--build_taxdb needs --taxdb to write the snapshot to')
+    if os.path.exists(dbfile):
+        NCBITaxa(dbfile=dbfile).update_taxonomy_database(taxdump_file=taxdump)
+    else:
+        # ete3 builds a missing database file on creation
+        NCBITaxa(dbfile=dbfile, taxdump_file=taxdump)
+    print ("Taxonomy database written to", dbfile)
@@ -11,9 +11,57 @@ except ImportError:
     import pickle
     
 import bz2
+import hashlib
+import heapq
+import tempfile
 from operator import itemgetter
 
 import argparse, sys, textwrap, os, pickle
+import multiprocessing
+from array import array
+
+sharedDatabase = {}
+
+# Output matrices built by aggregateRpkg and the read labels each one groups by
+RPKG_LEVELS = [
+    ('strat', ('function', 'taxon')),
+    ('unstrat', ('function',)),
+    ('strat_ec', ('ec', 'taxon')),
+    ('unstrat_ec', ('ec',)),
+]
+
+# Extra levels rolled up from the EC and function labels of each read, with the
+# label they are derived from (see rollupLabel): 'ecN' is the EC number cut to
+# its first N fields (--ec_levels), 'cog_category' the COG functional category
+# of the function (--cog_categories)
+ROLLUP_LEVELS = {
+    'ec1': [('strat_ec1', ('ec1', 'taxon')), ('unstrat_ec1', ('ec1',))],
+    'ec2': [('strat_ec2', ('ec2', 'taxon')), ('unstrat_ec2', ('ec2',))],
+    'ec3': [('strat_ec3', ('ec3', 'taxon')), ('unstrat_ec3', ('ec3',))],
+    'cog_category': [('strat_cog', ('cog_category', 'taxon')), ('unstrat_cog', ('cog_category',))],
+}
+
+ROLLUP_SOURCES = {'ec1': 'ec', 'ec2': 'ec', 'ec3': 'ec', 'cog_category': 'function'}
+
+# Read labels that are interned process-wide (see Interner); read and hit IDs
+# get a fresh Interner per sample instead
+globalIds = {}
+
+# Start of the output file name of each level, after --outputf
+RPKG_OUTPUT_NAMES = {
+    'strat': '-strat-matrix-RPKM',
+    'unstrat': '-unstrat-matrix-RPKM',
+    'strat_ec': '-strat-matrix-RPKM-withEC',
+    'unstrat_ec': '-unstrat-matrix-RPKM-withEC',
+    'strat_ec1': '-strat-matrix-RPKM-withEC-level1',
+    'unstrat_ec1': '-unstrat-matrix-RPKM-withEC-level1',
+    'strat_ec2': '-strat-matrix-RPKM-withEC-level2',
+    'unstrat_ec2': '-unstrat-matrix-RPKM-withEC-level2',
+    'strat_ec3': '-strat-matrix-RPKM-withEC-level3',
+    'unstrat_ec3': '-unstrat-matrix-RPKM-withEC-level3',
+    'strat_cog': '-strat-matrix-RPKM-withCOGcategory',
+    'unstrat_cog': '-unstrat-matrix-RPKM-withCOGcategory',
+}
 
 parser=argparse.ArgumentParser()
 
@@ -32,6 +80,35 @@ parser.add_argument('--multisample', help = textwrap.dedent('''For running multi
 
 parser.add_argument('--outputf', help = 'Start of the file name for writing all output files. Note that multiple will be saved with different file endings')
 
+parser.add_argument('--streaming', action = 'store_true', help = textwrap.dedent('''Walk the taxa, function and m8 files of each sample in step instead of loading them into memory;
+    peak memory then scales with the number of distinct functions rather than the number of reads.
+    The files are walked in the read order of the kraken2 taxa file, which lists every read; the function
+    and m8 files must list their reads in that same order, as MMseqs2 and Kraken2 write them for the same reads
+    '''))
+parser.add_argument('--sorted_by_read', action = 'store_true', help = textwrap.dedent('''With --streaming, the taxa, function and m8 files are instead all sorted by read ID in the same byte order
+    (needed for megan taxa files), e.g.: LC_ALL=C sort -t $'\\t' -k2,2 kraken2.out (kraken2) or
+    LC_ALL=C sort -t $'\\t' -k1,1 (function, megan and m8 files)
+    '''))
+parser.add_argument('--build_mmap_db', action = 'store_true', help = textwrap.dedent('''Convert the GeneLength, ECmapped and EC_descriptions .dict/.pbz2 files in --database
+    into memory-mapped .npy arrays next to them and exit. Later runs open these in milliseconds
+    and concurrent jobs on the same node share their pages
+    '''))
+parser.add_argument('--output_format', default = 'tsv', choices = ['tsv', 'mtx', 'biom'], help = textwrap.dedent('''Format of the function x sample matrices: tsv (default), mtx (Matrix Market, with .rows/.cols
+    files holding the function and sample names) or biom (BIOM HDF5, needs the biom-format package)
+    '''))
+parser.add_argument('--merge_join', action = 'store_true', help = textwrap.dedent('''Join the taxa and function files of each sample with a sorted-merge join on read ID, so that only
+    the reads classified by both are held in memory. Files that are not sorted by read ID are first
+    sorted on disk (in the directory given by TMPDIR)
+    '''))
+parser.add_argument('--sort_chunk_lines', type = int, default = 5000000, help = 'Lines sorted in memory at a time when --merge_join has to sort a file on disk (default: 5000000)')
+parser.add_argument('--ec_levels', help = textwrap.dedent('''Comma-separated EC levels to also roll the EC matrices up to in the same run, e.g. 1,2,3 for
+    EC classes, subclasses and sub-subclasses (level 4, the full EC number, is always written)
+    '''))
+parser.add_argument('--cog_categories', help = textwrap.dedent('''Tab-separated file whose first two columns map the function IDs of the function files to COG
+    functional categories (lines starting with # are skipped); adds matrices rolled up to these categories
+    '''))
+parser.add_argument('--processes', type = int, default = 1, help = 'Number of samples from the --multisample file to process in parallel (default: 1)')
+
 # parser.add_argument('--unstratified', help = 'Boolean Y|N to output unstratified metabolic functions; must choose at most one of --stratified or --unstratified')
 # parser.add_argument('--stratified', help = 'Boolean Y|N to output metabolic functions stratified by taxa; must choose at most one of --stratified or --unstratified')
 # parser.add_argument('--map2EC', help = 'Boolean Y|N to output a matrix of EC numbers in samples')
@@ -49,7 +126,12 @@ def main():
 
     # map2ECflag = args.map2EC
     
-    if os.path.exists(database+'/GeneLength.dict'):
+    # The memory-mapped arrays are preferred when present, except when they are being (re)built
+    use_mmap = not args.build_mmap_db
+    
+    if use_mmap and os.path.exists(database+'/GeneLength.ids.npy'):
+      genelendict = MmapGeneLengthDict(database+'/GeneLength')
+    elif os.path.exists(database+'/GeneLength.dict'):
       with open(database+'/GeneLength.dict', 'rb') as f:
         genelendict = pickle.load(f)
     elif os.path.exists(database+'/GeneLength.pbz2'):
@@ -59,7 +141,9 @@ def main():
       sys.exit('No gene length file (GeneLength.dict/GeneLength.pbz2) found in '+database)
     print('Imported gene length dictionary')
   
-    if os.path.exists(database+'/ECmapped.dict'):
+    if use_mmap and os.path.exists(database+'/ECmapped.ids.npy'):
+      Seq2ECdict = MmapECDict(database+'/ECmapped')
+    elif os.path.exists(database+'/ECmapped.dict'):
       with open(database+'/ECmapped.dict', 'rb') as f:
         Seq2ECdict = pickle.load(f)
     elif os.path.exists(database+'/ECmapped.pbz2'):
@@ -69,11 +153,15 @@ def main():
       sys.exit('No UniRef to EC dictionary (ECmapped.dict/ECmapped.pbz2) found in '+database)
     print('Imported UniRef to EC dictionary')
 
-    for seq in Seq2ECdict:
-      if isinstance(Seq2ECdict[seq], str):
-        Seq2ECdict[seq] = [Seq2ECdict[seq]]
+    if isinstance(Seq2ECdict, dict):
+      for seq in Seq2ECdict:
+        if isinstance(Seq2ECdict[seq], str):
+          Seq2ECdict[seq] = [Seq2ECdict[seq]]
     
-    if os.path.exists(database+'/EC_descriptions.dict'):
+    EC2descdict = None
+    if use_mmap and os.path.exists(database+'/EC_descriptions.ecs.npy'):
+      EC2descdict = dict(zip(np.load(database+'/EC_descriptions.ecs.npy'), np.load(database+'/EC_descriptions.desc.npy')))
+    elif os.path.exists(database+'/EC_descriptions.dict'):
       with open(database+'/EC_descriptions.dict', 'rb') as f:
         EC2descdict = pickle.load(f)
     elif os.path.exists(database+'/EC_descriptions.pbz2'):
@@ -83,6 +171,11 @@ def main():
       print("No EC descriptions dictionary (EC_descriptions.dict/EC_descriptions.pbz2) found in "+database+". Continuing, but be aware that this means that you won't get files with descriptions")
     print('Imported EC description dictionary')
     
+    if (args.build_mmap_db):
+      buildMmapDatabase(database,genelendict,Seq2ECdict,EC2descdict)
+      print('Wrote memory-mapped database to '+database)
+      return
+    
     # if (map2ECflag == "Y"):
     #     
     #     ECmapf = bz2.BZ2File(database+'/ECmapped.pbz2', 'rb')
@@ -113,38 +206,27 @@ def main():
     
     
     if not multi:
-        taxadict = {}
-        funcdict = {}
-
         taxafile = args.taxafile
         taxafiletype = args.taxafiletype
         funcfile = args.funcfile
         funcfiletype = args.funcfiletype
         m8file = args.m8file
         
-        print ("Running single sample:", taxafile,taxafiletype,funcfile,funcfiletype)
-        
-        (taxadict,funcdict) = coreRun(taxafile,taxafiletype,funcfile,funcfiletype)
+        if not (taxafile and taxafiletype and funcfile and funcfiletype and m8file):
+            sys.exit('Give either --multisample or all of --taxafile, --taxafiletype, --funcfile, --funcfiletype and --m8file')
         
-        print ("Total reads mapped to taxa: " + str(len(taxadict)))
-        print ("Total reads mapped to functions: " + str(len(funcdict)))
+        print ("Running single sample:", taxafile,taxafiletype,funcfile,funcfiletype)
         
-        combinedDict = mergeTaxaFunc(taxadict,funcdict)
-        print ("Reads mapped to either taxa OR functions: " + str(len(combinedDict)))
-        filteredDict = dict(filter(lambda x: len(x[1]) == 2, combinedDict.items()))
-                
-        print ("Reads mapped to both taxa AND functions: " + str(len(filteredDict)))
- 
-        funchash = defaultdict(list)
-        for key, value in sorted(filteredDict.items()):
-            funchash[value[1]].append(key)
+        # Run as a one-line --multisample file; the sample column is named after the taxa file
+        sampletag = os.path.splitext(os.path.basename(taxafile))[0]
+        sample_lines = [[sampletag,taxafile,taxafiletype,funcfile,funcfiletype,m8file]]
                 
     else:
         print ("Running multiple samples from file:", multi)
         
         with open(multi, newline = '') as multif:                                                                                          
             multi_reader = csv.reader(multif, delimiter='\t')
-            SampleFuncRpkgdict_strat, SampleFuncRpkgdict_unstrat, SampleFuncRpkgdict_strat_ec, SampleFuncRpkgdict_unstrat_ec = {}, {}, {}, {}
+            sample_lines = []
             for line in multi_reader:
                 
                 line_elements = len(line)
@@ -153,209 +235,60 @@ def main():
                 print ("Total elements:",line_elements)
                 if (line_elements != 6):
                     continue
-
-                taxadict = {}
-                funcdict = {}
-                tot_reads_mapped,taxa_AND_func_mapped,taxa_mapped,taxa_OR_func_mapped,func_mapped,EC_mapped = 0,0,0,0,0,0
-                perc_EC_mapped,perc_func_mapped,perc_taxa_AND_func_mapped,perc_taxa_mapped,perc_taxa_OR_func_mapped = 0,0,0,0,0
-                sampletag = line[0]
-                taxafile = line[1]
-                taxafiletype = line[2]
-                funcfile = line[3]
-                funcfiletype = line[4]
-                m8file = line[5]
-                
-                # if (funcfiletype == 'megan' and map2ECflag == "Y"):
-                #     #genlenf = bz2.BZ2File('RefGeneLength.pbz2', 'rb')
-                #     #genelendict = cPickle.load(genlenf)
-                #     genelendict = RSgenelendict
-                #     #RS2ECmapf = bz2.BZ2File('RsECmapped.pbz2', 'rb')
-                #     #Seq2ECdict = cPickle.load(RS2ECmapf)
-                #     Seq2ECdict = RS2ECdict
-                # elif (funcfiletype == 'megan' and map2ECflag == "N"):
-                #     #genlenf = bz2.BZ2File('RefGeneLength.pbz2', 'rb')
-                #     #genelendict = cPickle.load(genlenf)
-                #     genelendict = RSgenelendict
-                # elif (funcfiletype == 'uniref' and map2ECflag == "Y"):
-                #     #genlenf = bz2.BZ2File('UnirefGeneLength.pbz2', 'rb')
-                #     #genelendict = cPickle.load(genlenf)
-                #     genelendict = UPgenelendict
-                #     #RS2ECmapf = bz2.BZ2File('UpECmapped.pbz2', 'rb')
-                #     #RS2ECdict = cPickle.load(RS2ECmapf)
-                #     Seq2ECdict = UP2ECdict
-                # elif (funcfiletype == 'uniref' and map2ECflag == "N"):
-                #     #genlenf = bz2.BZ2File('UnirefGeneLength.pbz2', 'rb')
-                #     #genelendict = cPickle.load(genlenf)
-                #     genelendict = UPgenelendict
-                # elif (funcfiletype == 'COG' and map2ECflag == "Y"):
-                #     genelendict = COGgenelendict
-                #     Seq2ECdict = COG2ECdict
-                # elif (funcfiletype == 'COG' and map2ECflag == "N"):
-                #     genelendict = COGgenelendict
-                # elif (funcfiletype == 'refseq' and map2ECflag == "Y"):
-                #     genelendict = RSgenelendict
-                #     Seq2ECdict = RS2ECdict
-                # elif (funcfiletype == 'refseq' and map2ECflag == "N"):
-                #     genelendict = RSgenelendict
-                    
-                
-                print ("Current sample:", taxafile,taxafiletype,funcfile,funcfiletype,m8file)
-                (taxadict,funcdict,genedict) = coreRun(taxafile,taxafiletype,funcfile,funcfiletype,m8file)
-                
-                tot_reads_mapped = len(genedict)
-                
-                print ("Total reads mapped: " + str(tot_reads_mapped))
                 
-                taxa_mapped = len(taxadict)
-                func_mapped = len(funcdict)
-                perc_taxa_mapped = (taxa_mapped/tot_reads_mapped)*100
-                perc_func_mapped = (func_mapped/tot_reads_mapped)*100
-                
-                print ("Total reads mapped to taxa: " + str(len(taxadict)) + " percent " + str(perc_taxa_mapped))
-                print ("Total reads mapped to functions: " + str(len(funcdict)) + " percent " + str(perc_func_mapped))
+                sample_lines.append(line)
         
-                combinedDict = mergeTaxaFunc(taxadict,funcdict)
-                taxa_OR_func_mapped = len(combinedDict)
-                perc_taxa_OR_func_mapped = (taxa_OR_func_mapped/tot_reads_mapped)*100
-                
-                print ("Reads mapped to either taxa OR functions: " + str(len(combinedDict)) + " percent " + str(perc_taxa_OR_func_mapped))
-                
-                filteredDict = dict(filter(lambda x: len(x[1]) == 2, combinedDict.items()))
-                taxa_AND_func_mapped = len(filteredDict)
-                perc_taxa_AND_func_mapped = (taxa_AND_func_mapped/tot_reads_mapped)*100
-
-                print ("Reads mapped to both taxa AND functions: " + str(len(filteredDict)) + " percent " + str(perc_taxa_AND_func_mapped))
-                
-                first10pairs = {k: filteredDict[k] for k in list(filteredDict)[100:120]}
-                print("resultant dictionary taxa and func: \n", first10pairs)
-
-                
-                funchash = defaultdict(list)
-                for key, value in sorted(filteredDict.items()):
-                    key = str(key).rstrip('\n')
-                    val = str(value[1]).rstrip('\n')
-                    funchash[val].append(key)
-                            
-                #first10pairs = {k: funchash[k] for k in list(funchash)[100:120]}
-                #print("resultant dictionary : \n", first10pairs)
-            
-                print("Total unique functions: ", len(funchash))
-                
-                ge = len(filteredDict)
-                ge = ge/1000000
-                
-                EChash = mapRS2EC(funchash,Seq2ECdict,genedict)
-                    
-                EC_mapped = len(EChash)
-                perc_EC_mapped = (EC_mapped/func_mapped)*100
-                    
-                print ("Total ECs detected: ",str(len(EChash)) + " percent " + str(perc_EC_mapped))
-                
-                #SampleFuncRpkgdict_strat
-                functaxahash = stratified(funchash,filteredDict)
-                FuncRpkgDict = normalize_rpkg(functaxahash,genedict,genelendict,ge)
-                SampleFuncRpkgdict_strat[sampletag] = FuncRpkgDict
-                
-                #SampleFuncRpkgdict_unstrat
-                FuncRpkgDict = normalize_rpkg(funchash,genedict,genelendict,ge)
-                SampleFuncRpkgdict_unstrat[sampletag] = FuncRpkgDict
-                
-                #SampleFuncRpkgdict_strat_ec
-                ECtaxahash = stratified(EChash,filteredDict)
-                FuncRpkgDict = normalize_rpkg(ECtaxahash,genedict,genelendict,ge)
-                SampleFuncRpkgdict_strat_ec[sampletag] = FuncRpkgDict
-                
-                #SampleFuncRpkgdict_unstrat_ec
-                FuncRpkgDict = normalize_rpkg(EChash,genedict,genelendict,ge)
-                SampleFuncRpkgdict_unstrat_ec[sampletag] = FuncRpkgDict
-                                
-                # if (GEdictflag == "Y" and unstrat == "Y" and map2ECflag == "N"):
-                #     ge = GEdict.get(sampletag)
-                #     FuncRpkgDict = normalize_rpkg(funchash,genedict,genelendict,ge)
-                #     SampleFuncRpkgdict[sampletag] = FuncRpkgDict
-                # elif (GEdictflag == "Y" and strat == "Y" and map2ECflag == "N"):
-                #       ge = GEdict.get(sampletag)
-                #       functaxahash = stratified(funchash,filteredDict)
-                #       FuncRpkgDict = normalize_rpkg(functaxahash,genedict,genelendict,ge)
-                #       SampleFuncRpkgdict[sampletag] = FuncRpkgDict
-                # elif (GEdictflag == "Y" and unstrat == "Y" and map2ECflag == "Y"):
-                #     ge = GEdict.get(sampletag)
-                #     EChash = mapRS2EC(funchash,Seq2ECdict,genedict)
-                #     
-                #     EC_mapped = len(EChash)
-                #     perc_EC_mapped = (EC_mapped/tot_reads_mapped)*100
-                #     
-                #     print ("Total ECs detected: ",str(len(EChash)) + " percent " + str(perc_EC_mapped))
-                #     #first10pairs = {k: EChash[k] for k in list(EChash)[10:20]}
-                #     #print("resultant dictionary EC read hash: \n", first10pairs)
-                #     FuncRpkgDict = normalize_rpkg(EChash,genedict,genelendict,ge)
-                #     SampleFuncRpkgdict[sampletag] = FuncRpkgDict
-                # elif (GEdictflag == "Y" and strat == "Y" and map2ECflag == "Y"):
-                #     ge = GEdict.get(sampletag)
-                #     EChash = mapRS2EC(funchash,Seq2ECdict,genedict)
-                #     
-                #     EC_mapped = len(EChash)
-                #     perc_EC_mapped = (EC_mapped/tot_reads_mapped)*100
-                #     
-                #     print ("Total ECs detected: ",str(len(EChash)) + " percent " + str(perc_EC_mapped))
-                #     
-                #     ECtaxahash = stratified(EChash,filteredDict)
-                #     FuncRpkgDict = normalize_rpkg(ECtaxahash,genedict,genelendict,ge)
-                #     SampleFuncRpkgdict[sampletag] = FuncRpkgDict
-                # elif (GEdictflag == "N" and unstrat == "Y" and map2ECflag == "N"):
-                #     ge = len(filteredDict)
-                #     ge = ge/1000000
-                #     FuncRpkgDict = normalize_rpkg(funchash,genedict,genelendict,ge)
-                #     SampleFuncRpkgdict[sampletag] = FuncRpkgDict
-                # elif (GEdictflag == "N" and strat == "Y" and map2ECflag == "N"):
-                #     ge = len(filteredDict)
-                #     ge = ge/1000000
-                #     functaxahash = stratified(funchash,filteredDict)
-                #     FuncRpkgDict = normalize_rpkg(functaxahash,genedict,genelendict,ge)
-                #     SampleFuncRpkgdict[sampletag] = FuncRpkgDict
-                # elif (GEdictflag == "N" and unstrat == "Y" and map2ECflag == "Y"):
-                #     ge = len(filteredDict)
-                #     ge = ge/1000000
-                #     EChash = mapRS2EC(funchash,Seq2ECdict,genedict)
-                #     
-                #     EC_mapped = len(EChash)
-                #     perc_EC_mapped = (EC_mapped/tot_reads_mapped)*100
-                #     
-                #     print ("Total ECs detected: ",str(len(EChash)) + " percent " + str(perc_EC_mapped))
-                #     #first10pairs = {k: EChash[k] for k in list(EChash)[10:20]}
-                #     #print("resultant dictionary EC read hash: \n", first10pairs)
-                #     FuncRpkgDict = normalize_rpkg(EChash,genedict,genelendict,ge)
-                #     SampleFuncRpkgdict[sampletag] = FuncRpkgDict
-                # elif (GEdictflag == "N" and strat == "Y" and map2ECflag == "Y"):
-                #     ge = len(filteredDict)
-                #     ge = ge/1000000
-                #     EChash = mapRS2EC(funchash,Seq2ECdict,genedict)
-                #     
-                #     EC_mapped = len(EChash)
-                #     perc_EC_mapped = (EC_mapped/tot_reads_mapped)*100
-                #     
-                #     print ("Total ECs detected: ",str(len(EChash)) + " percent " + str(perc_EC_mapped))
-                # 
-                #     ECtaxahash = stratified(EChash,filteredDict)
-                #     FuncRpkgDict = normalize_rpkg(ECtaxahash,genedict,genelendict,ge)
-                #     SampleFuncRpkgdict[sampletag] = FuncRpkgDict
-                # #else:
-                #     #print ("MicrobeCensus result not found; Will not normalize")
-            
+    if (args.streaming and not args.sorted_by_read):
+        for line in sample_lines:
+            if (line[2] != 'kraken2'):
+                sys.exit('--streaming follows the read order of kraken2 taxa files; sort the files of ' + line[0] + ' by read ID and add --sorted_by_read')
+    
+    # The reference dictionaries are module globals so that forked workers
+    # share the parent's copy-on-write pages instead of receiving pickles
+    sharedDatabase['genelendict'] = genelendict
+    sharedDatabase['Seq2ECdict'] = Seq2ECdict
+    
+    levels = list(RPKG_LEVELS)
+    if (args.ec_levels):
+        for level in parseECLevels(args.ec_levels):
+            # level 4 is the full EC number, already in RPKG_LEVELS
+            if (level != 4):
+                levels += ROLLUP_LEVELS['ec'+str(level)]
+    if (args.cog_categories):
+        sharedDatabase['cog_categories'] = parseCOGCategories(args.cog_categories)
+        levels += ROLLUP_LEVELS['cog_category']
     
-    all_dicts = [SampleFuncRpkgdict_strat, SampleFuncRpkgdict_unstrat, SampleFuncRpkgdict_strat_ec, SampleFuncRpkgdict_unstrat_ec]
-    names = ['-strat-matrix-RPKM.txt', '-unstrat-matrix-RPKM.txt', '-strat-matrix-RPKM-withEC.txt', '-unstrat-matrix-RPKM-withEC.txt']
+    # Samples fail with InputError rather than sys.exit: a SystemExit in a pool
+    # worker kills it without returning, and starmap then waits forever
+    try:
+        if (args.processes > 1):
+            with multiprocessing.get_context('fork').Pool(args.processes) as pool:
+                results = pool.starmap(runSample, [(line, args.streaming, args.merge_join, args.sort_chunk_lines, levels, args.sorted_by_read) for line in sample_lines])
+        else:
+            results = [runSample(line, args.streaming, args.merge_join, args.sort_chunk_lines, levels, args.sorted_by_read) for line in sample_lines]
+    except InputError as e:
+        sys.exit(str(e))
     
+    # Sparse function x sample matrices; the dense frame is never built
+    matrices = {name: SparseSampleMatrix() for name, keys in levels}
+    for result in results:
+        sampletag = result[0]
+        for (name, keys), FuncRpkgDict in zip(levels, result[1:]):
+            matrices[name].add_sample(sampletag, FuncRpkgDict)
+
+        
+
     print('Saving files now')
     
-    for s in range(len(all_dicts)):
-      SampleFuncRpkgdict = all_dicts[s]
-      pdDF = pd.DataFrame.from_dict(SampleFuncRpkgdict, orient='index')
-      pdDF.fillna(0, inplace = True)
-      pdDFT = pdDF.T
-      pdDFT.columns.name = 'function'
-      print (pdDFT.columns)
-      pd.DataFrame.to_csv(pdDFT, path_or_buf=outfile+names[s], sep='\t', na_rep='', header=True, index=True, index_label='function', mode='w', lineterminator='\n')
+    for name, keys in levels:
+      matrix = matrices[name]
+      print (name, "functions:", len(matrix.funcs), "samples:", len(matrix.samples))
+      if (args.output_format == 'mtx'):
+        matrix.write_mtx(outfile+RPKG_OUTPUT_NAMES[name]+'.mtx')
+      elif (args.output_format == 'biom'):
+        matrix.write_biom(outfile+RPKG_OUTPUT_NAMES[name]+'.biom')
+      else:
+        matrix.write_tsv(outfile+RPKG_OUTPUT_NAMES[name]+'.txt')
       
     
     # pdDF = pd.DataFrame.from_dict(SampleFuncRpkgdict, orient='index')
@@ -370,29 +303,412 @@ def main():
     # pd.DataFrame.to_csv(pdDFT, path_or_buf=outfile, sep='\t', na_rep='', header=True, index=True, index_label='function', mode='w', line_terminator='\n', escapechar=None, decimal='.')
         
 
-def mapRS2EC(FuncReadHash,rs2ecdict,read2rsdict):
+class SparseSampleMatrix:
+    # Function x sample RPKG matrix kept as COO triplets, one block per sample.
+    # Missing and NaN entries are 0, as with the previous fillna(0).
+    
+    def __init__(self):
+        self.func_index = {}
+        self.samples = []
+        self.rows, self.cols, self.vals = [], [], []
+    
+    @property
+    def funcs(self):
+        return list(self.func_index)
+    
+    def add_sample(self, sampletag, FuncRpkgDict):
+        col = len(self.samples)
+        self.samples.append(sampletag)
+        
+        rows = np.fromiter((self.func_index.setdefault(func, len(self.func_index)) for func in FuncRpkgDict), dtype=np.int64, count=len(FuncRpkgDict))
+        vals = np.fromiter(FuncRpkgDict.values(), dtype=np.float64, count=len(FuncRpkgDict))
+        keep = ~np.isnan(vals) & (vals != 0)
+        
+        self.rows.append(rows[keep])
+        self.cols.append(np.full(keep.sum(), col, dtype=np.int64))
+        self.vals.append(vals[keep])
+    
+    def csr(self):
+        # (indptr, sample columns, values) with the entries sorted by function
+        rows = np.concatenate(self.rows) if self.rows else np.zeros(0, dtype=np.int64)
+        cols = np.concatenate(self.cols) if self.cols else np.zeros(0, dtype=np.int64)
+        vals = np.concatenate(self.vals) if self.vals else np.zeros(0)
+        order = np.lexsort((cols, rows))
+        indptr = np.zeros(len(self.func_index) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.func_index)), out=indptr[1:])
+        return indptr, cols[order], vals[order]
+    
+    def write_tsv(self, filename):
+        # One dense row at a time, in the same layout as the old DataFrame.to_csv
+        indptr, cols, vals = self.csr()
+        row = np.zeros(len(self.samples))
+        
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(['function'] + self.samples)
+            for i, func in enumerate(self.func_index):
+                row[:] = 0
+                row[cols[indptr[i]:indptr[i + 1]]] = vals[indptr[i]:indptr[i + 1]]
+                writer.writerow([func] + [repr(val) for val in row.tolist()])
+    
+    def write_mtx(self, filename):
+        indptr, cols, vals = self.csr()
+        rows = np.repeat(np.arange(len(self.func_index)), np.diff(indptr))
+        
+        with open(filename, 'w') as f:
+            f.write('%%MatrixMarket matrix coordinate real general\n')
+            f.write(str(len(self.func_index)) + ' ' + str(len(self.samples)) + ' ' + str(len(vals)) + '\n')
+            for i, j, val in zip((rows + 1).tolist(), (cols + 1).tolist(), vals.tolist()):
+                f.write(str(i) + ' ' + str(j) + ' ' + repr(val) + '\n')
+        
+        with open(filename + '.rows', 'w') as f:
+            f.writelines(func + '\n' for func in self.func_index)
+        with open(filename + '.cols', 'w') as f:
+            f.writelines(sample + '\n' for sample in self.samples)
+    
+    def write_biom(self, filename):
+        try:
+            from biom.table import Table
+            from biom.util import biom_open
+            from scipy.sparse import csr_matrix
+        except ImportError:
+            sys.exit('The biom-format package is needed for --output_format biom')
+        
+        indptr, cols, vals = self.csr()
+        data = csr_matrix((vals, cols, indptr), shape=(len(self.func_index), len(self.samples)))
+        table = Table(data, self.funcs, self.samples)
+        with biom_open(filename, 'w') as f:
+            table.to_hdf5(f, 'parse_TaxonomyFunction_single.py')
+
+
+class InputError(Exception):
+    # Bad input found while running a sample; main() exits with its message
+    pass
+
+
+class Interner:
+    # Hands out consecutive int codes for strings, keeping one copy of each
+    # string so that codes can be decoded again at output time
+    
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+    
+    def __len__(self):
+        return len(self.strings)
+    
+    def code(self, string):
+        code = self.index.get(string)
+        if code is None:
+            code = self.index[string] = len(self.strings)
+            self.strings.append(string)
+        return code
+
+
+def globalInterner(name):
+    if name not in globalIds:
+        globalIds[name] = Interner()
+    return globalIds[name]
+
+
+def runSample(line,streaming,merge_join=False,sort_chunk_lines=5000000,levels=None,sorted_by_read=False):
+    # Run one line of the --multisample file and return the sample tag with its
+    # RPKG dicts of every level in levels (by default RPKG_LEVELS: strat,
+    # unstrat, strat-EC and unstrat-EC)
+    genelendict = sharedDatabase['genelendict']
+    Seq2ECdict = sharedDatabase['Seq2ECdict']
+    
+    sampletag = line[0]
+    taxafile = line[1]
+    taxafiletype = line[2]
+    funcfile = line[3]
+    funcfiletype = line[4]
+    m8file = line[5]
+    
+    taxadict = {}
+    funcdict = {}
+    tot_reads_mapped,taxa_AND_func_mapped,taxa_mapped,taxa_OR_func_mapped,func_mapped,EC_mapped = 0,0,0,0,0,0
+    perc_EC_mapped,perc_func_mapped,perc_taxa_AND_func_mapped,perc_taxa_mapped,perc_taxa_OR_func_mapped = 0,0,0,0,0
+    
+    # if (funcfiletype == 'megan' and map2ECflag == "Y"):
+    #     #genlenf = bz2.BZ2File('RefGeneLength.pbz2', 'rb')
+    #     #genelendict = cPickle.load(genlenf)
+    #     genelendict = RSgenelendict
+    #     #RS2ECmapf = bz2.BZ2File('RsECmapped.pbz2', 'rb')
+    #     #Seq2ECdict = cPickle.load(RS2ECmapf)
+    #     Seq2ECdict = RS2ECdict
+    # elif (funcfiletype == 'megan' and map2ECflag == "N"):
+    #     #genlenf = bz2.BZ2File('RefGeneLength.pbz2', 'rb')
+    #     #genelendict = cPickle.load(genlenf)
+    #     genelendict = RSgenelendict
+    # elif (funcfiletype == 'uniref' and map2ECflag == "Y"):
+    #     #genlenf = bz2.BZ2File('UnirefGeneLength.pbz2', 'rb')
+    #     #genelendict = cPickle.load(genlenf)
+    #     genelendict = UPgenelendict
+    #     #RS2ECmapf = bz2.BZ2File('UpECmapped.pbz2', 'rb')
+    #     #RS2ECdict = cPickle.load(RS2ECmapf)
+    #     Seq2ECdict = UP2ECdict
+    # elif (funcfiletype == 'uniref' and map2ECflag == "N"):
+    #     #genlenf = bz2.BZ2File('UnirefGeneLength.pbz2', 'rb')
+    #     #genelendict = cPickle.load(genlenf)
+    #     genelendict = UPgenelendict
+    # elif (funcfiletype == 'COG' and map2ECflag == "Y"):
+    #     genelendict = COGgenelendict
+    #     Seq2ECdict = COG2ECdict
+    # elif (funcfiletype == 'COG' and map2ECflag == "N"):
+    #     genelendict = COGgenelendict
+    # elif (funcfiletype == 'refseq' and map2ECflag == "Y"):
+    #     genelendict = RSgenelendict
+    #     Seq2ECdict = RS2ECdict
+    # elif (funcfiletype == 'refseq' and map2ECflag == "N"):
+    #     genelendict = RSgenelendict
+        
+    
+    print ("Current sample:", taxafile,taxafiletype,funcfile,funcfiletype,m8file)
+    
+    if levels is None:
+        levels = RPKG_LEVELS
+    
+    if (streaming):
+        return (sampletag,) + streamRun(taxafile,taxafiletype,funcfile,funcfiletype,m8file,Seq2ECdict,genelendict,levels,sorted_by_read)
+    
+    # Reads and hit IDs are interned per sample, functions/taxa/ECs in globalIds
+    read_ids, hit_ids = Interner(), Interner()
+    if (merge_join):
+        # Only the reads with both a taxon and a function come back from the join
+        (taxa_reads,taxa_codes),(func_reads,func_codes),join_counts = joinTaxaFunc(taxafile,taxafiletype,funcfile,funcfiletype,read_ids,sort_chunk_lines)
+        print ("m8 file given...processing")
+        (m8_reads,m8_hits) = parseBlastm8(m8file,read_ids,hit_ids)
+    else:
+        (taxa_reads,taxa_codes),(func_reads,func_codes),(m8_reads,m8_hits) = coreRun(taxafile,taxafiletype,funcfile,funcfiletype,m8file,read_ids,hit_ids)
+    
+    # Taxon / function code of every read, -1 if it has none
+    read_taxon = np.full(len(read_ids), -1, dtype=np.int32)
+    read_taxon[taxa_reads] = taxa_codes
+    read_func = np.full(len(read_ids), -1, dtype=np.int32)
+    read_func[func_reads] = func_codes
+    hit_counts = np.bincount(m8_reads, minlength=len(read_ids))
+    
+    tot_reads_mapped = np.count_nonzero(hit_counts)
+    
+    print ("Total reads mapped: " + str(tot_reads_mapped))
+    
+    if (merge_join):
+        taxa_mapped,func_mapped,taxa_OR_func_mapped = join_counts
+    else:
+        taxa_mapped = np.count_nonzero(read_taxon >= 0)
+        func_mapped = np.count_nonzero(read_func >= 0)
+        taxa_OR_func_mapped = np.count_nonzero((read_taxon >= 0) | (read_func >= 0))
+    perc_taxa_mapped = (taxa_mapped/tot_reads_mapped)*100
+    perc_func_mapped = (func_mapped/tot_reads_mapped)*100
+    
+    print ("Total reads mapped to taxa: " + str(taxa_mapped) + " percent " + str(perc_taxa_mapped))
+    print ("Total reads mapped to functions: " + str(func_mapped) + " percent " + str(perc_func_mapped))
+
+    perc_taxa_OR_func_mapped = (taxa_OR_func_mapped/tot_reads_mapped)*100
     
-    ec2readhash = defaultdict(list)
-    read2echash = {}
+    print ("Reads mapped to either taxa OR functions: " + str(taxa_OR_func_mapped) + " percent " + str(perc_taxa_OR_func_mapped))
+    
+    reads = np.flatnonzero((read_taxon >= 0) & (read_func >= 0))
+    taxa_AND_func_mapped = len(reads)
+    perc_taxa_AND_func_mapped = (taxa_AND_func_mapped/tot_reads_mapped)*100
+
+    print ("Reads mapped to both taxa AND functions: " + str(taxa_AND_func_mapped) + " percent " + str(perc_taxa_AND_func_mapped))
+    
+    first10pairs = {read_ids.strings[read]: [globalIds['taxon'].strings[read_taxon[read]], globalIds['function'].strings[read_func[read]]] for read in reads[100:120]}
+    print("resultant dictionary taxa and func: \n", first10pairs)
+
+    # Order the reads by read ID, then group them by function in order of first appearance
+    reads = np.array(sorted(reads, key=read_ids.strings.__getitem__), dtype=np.int64)
+    reads = reads[np.argsort(pd.factorize(read_func[reads])[0], kind='stable')]
     
-    for func, readarray in FuncReadHash.items():
-        for read in readarray:
-            rsidarray = read2rsdict[read]
-            #print ("RefSeq Ids: ", rsidarray)
-            ECarray = getECsforRSIds(rsidarray, rs2ecdict)
-            #print ("EC lis: ", ECarray)
-            if (ECarray):
-                #print ("EC lis: ", ECarray)
-                MFreqEC = rankECsforRead(ECarray)
-                read2echash[read]=MFreqEC
+    print("Total unique functions: ", len(np.unique(read_func[reads])))
     
-    for readid, ec in read2echash.items():
-        ec = "EC:" + str(ec)
-        ec2readhash[ec].append(readid)
+    ge = taxa_AND_func_mapped
+    ge = ge/1000000
     
+    # Hits of each read as runs of one read-sorted array of hit codes
+    hit_order = np.argsort(m8_reads, kind='stable')
+    read_hits = (np.concatenate(([0], np.cumsum(hit_counts))), m8_hits[hit_order])
     
-    return ec2readhash
+    read_ec = readECCodes(reads,read_hits,hit_ids,Seq2ECdict)
         
+    EC_mapped = len(np.unique(read_ec[read_ec >= 0]))
+    perc_EC_mapped = (EC_mapped/func_mapped)*100
+        
+    print ("Total ECs detected: ",str(EC_mapped) + " percent " + str(perc_EC_mapped))
+    
+    read_labels = {
+        'function': read_func[reads],
+        'ec': read_ec,
+        'taxon': read_taxon[reads]
+    }
+    read_labels.update(rollupLabelCodes(read_labels,levels))
+    hit_lengths = geneLengthArray(hit_ids.strings,genelendict)
+    read_avg_gene_length = runMeans(hit_counts[reads], hit_lengths[read_hits[1][runIndices(read_hits[0][reads], hit_counts[reads])]])
+    
+    FuncRpkgDicts = aggregateRpkg(read_labels,read_avg_gene_length,ge,levels)
+    
+    return (sampletag,) + tuple(FuncRpkgDicts[name] for name, keys in levels)
+
+
+def idHashes(ids):
+    # Stable 64-bit hashes of sequence IDs (the built-in hash() is salted per process)
+    return np.fromiter((int.from_bytes(hashlib.blake2b(str(i).encode(), digest_size=8).digest(), 'little') for i in ids),
+                       dtype=np.uint64, count=len(ids))
+
+
+def buildMmapDatabase(database,genelendict,seq2ecdict,ec2descdict):
+    # Write the reference dicts as sorted ID hash arrays with aligned values:
+    # GeneLength.{ids,len}.npy, CSR-style ECmapped.{ids,indptr,indices,ecs}.npy
+    # and EC_descriptions.{ecs,desc}.npy
+    
+    ids = idHashes(list(genelendict))
+    lengths = np.fromiter(genelendict.values(), dtype=np.int32, count=len(genelendict))
+    order = np.argsort(ids)
+    checkUniqueHashes(ids[order], 'GeneLength')
+    np.save(database+'/GeneLength.ids.npy', ids[order])
+    np.save(database+'/GeneLength.len.npy', lengths[order])
+    
+    seqs = list(seq2ecdict)
+    ids = idHashes(seqs)
+    order = np.argsort(ids)
+    checkUniqueHashes(ids[order], 'ECmapped')
+    ecs = sorted({ec for seq in seqs for ec in seq2ecdict[seq]})
+    ec_index = {ec: i for i, ec in enumerate(ecs)}
+    counts = np.fromiter((len(seq2ecdict[seqs[i]]) for i in order), dtype=np.int64, count=len(seqs))
+    indptr = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.fromiter((ec_index[ec] for i in order for ec in seq2ecdict[seqs[i]]), dtype=np.int32, count=indptr[-1])
+    np.save(database+'/ECmapped.ids.npy', ids[order])
+    np.save(database+'/ECmapped.indptr.npy', indptr)
+    np.save(database+'/ECmapped.indices.npy', indices)
+    np.save(database+'/ECmapped.ecs.npy', np.array(ecs, dtype=str))
+    
+    if (ec2descdict):
+        np.save(database+'/EC_descriptions.ecs.npy', np.array(list(ec2descdict), dtype=str))
+        np.save(database+'/EC_descriptions.desc.npy', np.array(list(ec2descdict.values()), dtype=str))
+
+
+def checkUniqueHashes(sorted_ids,name):
+    if (len(sorted_ids) > 1 and not np.all(sorted_ids[1:] != sorted_ids[:-1])):
+        sys.exit('Two IDs in '+name+' share the same 64-bit hash; the memory-mapped database cannot be built')
+
+
+class MmapGeneLengthDict:
+    # Read-only, dict-like view of GeneLength.{ids,len}.npy
+    
+    def __init__(self, prefix):
+        self.ids = np.load(prefix+'.ids.npy', mmap_mode='r')
+        self.lengths = np.load(prefix+'.len.npy', mmap_mode='r')
+    
+    def find(self, keys):
+        # Row of each key in the sorted ID array, or -1 if the key is absent
+        hashes = idHashes(keys)
+        rows = np.searchsorted(self.ids, hashes)
+        rows[rows == len(self.ids)] = 0
+        found = len(self.ids) > 0 and self.ids[rows] == hashes
+        return np.where(found, rows, -1)
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def __contains__(self, key):
+        return self.find([key])[0] >= 0
+    
+    def get(self, key, default=None):
+        row = self.find([key])[0]
+        if (row < 0):
+            return default
+        return int(self.lengths[row])
+
+
+class MmapECDict(MmapGeneLengthDict):
+    # Read-only, dict-like view of ECmapped.{ids,indptr,indices,ecs}.npy;
+    # values are lists of EC numbers, as in ECmapped.dict
+    
+    def __init__(self, prefix):
+        self.ids = np.load(prefix+'.ids.npy', mmap_mode='r')
+        self.indptr = np.load(prefix+'.indptr.npy', mmap_mode='r')
+        self.indices = np.load(prefix+'.indices.npy', mmap_mode='r')
+        self.ecs = np.load(prefix+'.ecs.npy')
+    
+    def get(self, key, default=None):
+        row = self.find([key])[0]
+        if (row < 0):
+            return default
+        return [str(ec) for ec in self.ecs[self.indices[self.indptr[row]:self.indptr[row + 1]]]]
+
+
+def readECCodes(reads,read_hits,hit_ids,rs2ecdict):
+    # Interned most frequent EC ("EC:x.x.x.x") among the hits of each read, -1
+    # if none; ties go to the EC that sorts first.
+    # All (read, EC) pairs are expanded from CSR arrays and voted on at once.
+    indptr, hits = read_hits
+    hit_counts = indptr[reads + 1] - indptr[reads]
+    hit_codes, unique_hits = pd.factorize(hits[runIndices(indptr[reads], hit_counts)])
+    modal_ec, ec_names = modalECs(hit_counts,hit_codes,[hit_ids.strings[hit] for hit in unique_hits],rs2ecdict)
+    
+    read_ec = np.full(len(reads), -1, dtype=np.int32)
+    has_ec = modal_ec >= 0
+    if has_ec.any():
+        ec_ids = globalInterner('ec')
+        winners, winner_codes = np.unique(modal_ec[has_ec], return_inverse=True)
+        read_ec[has_ec] = np.array([ec_ids.code("EC:" + str(ec_names[ec])) for ec in winners], dtype=np.int32)[winner_codes]
+    
+    return read_ec
+
+
+def modalECs(hit_counts,hit_codes,unique_hits,rs2ecdict):
+    # Most frequent EC of each read, from the number of hits of every read and
+    # the codes (into unique_hits) of all their hits laid end to end. Returns
+    # the index of each read's EC in ec_names (-1 if none) and ec_names.
+    ec_indptr, ec_codes, ec_names = hitECArrays(unique_hits, rs2ecdict)
+    
+    ec_counts = (ec_indptr[1:] - ec_indptr[:-1])[hit_codes]
+    pair_read = np.repeat(np.repeat(np.arange(len(hit_counts)), hit_counts), ec_counts)
+    pair_ec = ec_codes[runIndices(ec_indptr[hit_codes], ec_counts)]
+    
+    return modalCodes(pair_read, pair_ec, len(hit_counts), len(ec_names)), ec_names
+
+
+def hitECArrays(hits,rs2ecdict):
+    # ECs of each hit ID as CSR arrays (indptr, codes) over the sorted EC names
+    if isinstance(rs2ecdict, MmapECDict):
+        rows = rs2ecdict.find(hits)
+        found = rows >= 0
+        starts = np.where(found, rs2ecdict.indptr[rows], 0)
+        counts = np.where(found, rs2ecdict.indptr[rows + 1] - starts, 0)
+        codes = np.asarray(rs2ecdict.indices[runIndices(starts, counts)], dtype=np.int64)
+        ec_names = rs2ecdict.ecs
+    else:
+        hit_ecs = [getECsforRSIds([hit], rs2ecdict) for hit in hits]
+        ec_names = sorted({ec for ecarray in hit_ecs for ec in ecarray})
+        ec_index = {ec: i for i, ec in enumerate(ec_names)}
+        counts = np.fromiter((len(ecarray) for ecarray in hit_ecs), dtype=np.int64, count=len(hit_ecs))
+        codes = np.fromiter((ec_index[ec] for ecarray in hit_ecs for ec in ecarray), dtype=np.int64, count=counts.sum())
+    
+    indptr = np.zeros(len(hits) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, codes, ec_names
+
+
+def modalCodes(pair_rows,pair_codes,n_rows,n_codes):
+    # Most frequent code of each row over (row, code) pairs, the smallest code
+    # on ties, -1 for rows without pairs
+    modal = np.full(n_rows, -1, dtype=np.int64)
+    if (len(pair_rows) == 0):
+        return modal
+    
+    keys, counts = np.unique(pair_rows.astype(np.int64) * n_codes + pair_codes, return_counts=True)
+    key_rows, key_codes = np.divmod(keys, n_codes)
+    order = np.lexsort((key_codes, -counts, key_rows))
+    key_rows, key_codes = key_rows[order], key_codes[order]
+    first = np.unique(key_rows, return_index=True)[1]
+    modal[key_rows[first]] = key_codes[first]
+    
+    return modal
+
 
 def getECsforRSIds(rsidsarr,rs2echash):
     # get a list of ECs mapped to RefSeq IDs for a given read
@@ -405,73 +721,137 @@ def getECsforRSIds(rsidsarr,rs2echash):
     
     return fullECarray
     
-def rankECsforRead(ecarray):
-    # get the most frequent EC in the list for each read
+def aggregateRpkg(read_labels,read_avg_gene_length,GE,levels=None):
+    # Group the reads once by all their labels together (function, EC, taxon),
+    # then roll these groups up to every output level of RPKG_LEVELS. Labels
+    # are codes of the globalIds interner of the same name; reads with a -1
+    # label are left out of the levels that use that label.
+    if levels is None:
+        levels = RPKG_LEVELS
     
-    unique, counts = np.unique(ecarray, return_counts=True)
-    #print ("Unique + counts: ", unique, counts)
-    ecCounts = {k: v for k, v in zip(unique, counts)}
+    names = list(read_labels)
+    codes, uniques = {}, {}
+    for name in names:
+        labels = np.asarray(read_labels[name])
+        codes[name], uniques[name] = pd.factorize(labels)
+        codes[name][labels < 0] = -1
     
-    sorted_ecCounts = sorted(ecCounts.items(), key = itemgetter(1),reverse = True)
-    
-    #print ("EC counts: ", sorted_ecCounts, type(sorted_ecCounts))
-    
-    mfreqECcountTup = sorted_ecCounts[0]
-    
-    mfreEC = mfreqECcountTup[0]
-    
-    return mfreEC
+    read_groups = pd.DataFrame(codes).groupby(names, sort=False).ngroup().to_numpy()
+    group_first_read = np.unique(read_groups, return_index=True)[1]
+    group_codes = pd.DataFrame({name: codes[name][group_first_read] for name in names})
+    group_numreads = np.bincount(read_groups, minlength=len(group_codes))
+    group_lengthsum = np.bincount(read_groups, weights=read_avg_gene_length, minlength=len(group_codes))
     
+    FuncRpkgDicts = {}
+    for name, keys in levels:
+        keys = list(keys)
+        assigned = (group_codes[keys] >= 0).all(axis=1).to_numpy()
+        level_codes = group_codes.loc[assigned, keys]
+        level_groups = level_codes.groupby(keys, sort=False).ngroup().to_numpy()
+        level_first_group = np.unique(level_groups, return_index=True)[1]
+        
+        numreads = np.bincount(level_groups, weights=group_numreads[assigned], minlength=len(level_first_group))
+        lengthkb = np.bincount(level_groups, weights=group_lengthsum[assigned], minlength=len(level_first_group))/numreads/1000
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rpkg = numreads/lengthkb/GE if GE else np.full(len(numreads), np.nan)
+        rpkg[lengthkb == 0] = np.nan
+        
+        # Order the rows by their leading label, as the per-function read hashes did
+        first_codes = level_codes.iloc[level_first_group]
+        order = np.argsort(first_codes[keys[0]].to_numpy(), kind='stable')
+        first_codes, rpkg = first_codes.iloc[order], rpkg[order]
+        funcs = ['|'.join(labels) for labels in zip(*([globalIds[key].strings[label] for label in uniques[key][first_codes[key].to_numpy()]] for key in keys))]
+        FuncRpkgDicts[name] = defaultdict(list, zip(funcs, rpkg.tolist()))
     
-def stratified(FuncReadHash,filtFuncTaxadict):
-    # Stratify the function hash, 
-    # i.e break down each function into taxonomic classes and
-    # return a new hash with function-taxa pair keys
+    return FuncRpkgDicts
+
+
+def rollupLabelCodes(read_labels,levels):
+    # Codes of the roll-up labels (ROLLUP_SOURCES) used by levels, mapped from
+    # the codes of the EC or function label of each read
+    names = {key for name, keys in levels for key in keys if key in ROLLUP_SOURCES}
     
-    taxahash = defaultdict(list)
-    for key, value in sorted(filtFuncTaxadict.items()):
-        taxahash[key] = value[0]
+    rollup_labels = {}
+    for name in sorted(names):
+        source_ids, rollup_ids = globalInterner(ROLLUP_SOURCES[name]), globalInterner(name)
+        lookup = np.full(len(source_ids) + 1, -1, dtype=np.int32)
+        for code, label in enumerate(source_ids.strings):
+            rollup = rollupLabel(name, label)
+            if (rollup is not None):
+                lookup[code] = rollup_ids.code(rollup)
+        # source code -1 picks the trailing -1
+        rollup_labels[name] = lookup[read_labels[ROLLUP_SOURCES[name]]]
     
-    stratified_hash = defaultdict(list)
-    for func,readarray in FuncReadHash.items():
-        for read in readarray:
-            taxon = taxahash[read]
-            functaxakey = str(func).rstrip('\n') + "|" + str(taxon).rstrip('\n')
-            
-            stratified_hash[functaxakey].append(read)
-                           
-    return stratified_hash
+    return rollup_labels
+
+
+def rollupLabel(name,label):
+    # Roll-up label name ('ecN' or 'cog_category') of an EC ("EC:x.x.x.x") or
+    # function label; None if the function has no COG category
+    if (name == 'cog_category'):
+        return sharedDatabase['cog_categories'].get(label)
     
+    level = int(name[2:])
+    return "EC:" + ".".join(label[3:].split(".")[:level])
+
+
+def parseECLevels(ec_levels):
+    # Distinct, sorted EC levels of the comma-separated --ec_levels value
+    levels = set()
+    for level in ec_levels.split(','):
+        try:
+            level = int(level)
+        except ValueError:
+            sys.exit('--ec_levels takes comma-separated EC levels from 1 to 4, e.g. 1,2,3; got '+repr(level))
+        if (level < 1 or level > 4):
+            sys.exit('--ec_levels takes EC levels from 1 to 4; got '+str(level))
+        levels.add(level)
+    return sorted(levels)
+
+
+def parseCOGCategories(filename):
+    d = {}
+    with open(filename) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split("\t")
+            if (len(fields) > 1):
+                d[fields[0]] = fields[1]
+    return d
+
+
+def runMeans(counts,values):
+    # Mean of each of the consecutive runs of values with the given lengths (0 for empty runs)
+    means = np.zeros(len(counts))
+    nonempty = counts > 0
+    if nonempty.any():
+        starts = np.cumsum(counts) - counts
+        means[nonempty] = np.add.reduceat(values, starts[nonempty])/counts[nonempty]
     
+    return means
 
-def normalize_rpkg(dict_reads_mapped_to_func,dict_genes_mapped_to_read,refseq_gene_len_dict,GE):
-    FuncRPKGdict = defaultdict(list)
+
+def runIndices(starts,counts):
+    # Positions of the runs [start, start + count) laid end to end
+    ends = np.cumsum(counts)
+    total = ends[-1] if len(ends) else 0
+    return np.repeat(starts - (ends - counts), counts) + np.arange(total)
+
+
+def geneLengthArray(genes,refseq_gene_len_dict):
+    # Gene length of every hit, looking each distinct ID up only once; NaN if unknown
+    gene_codes, unique_genes = pd.factorize(np.array(genes, dtype=object))
     
-    for func,readarray in dict_reads_mapped_to_func.items():
-                    FuncLengthArray = []
-                    for read in readarray:
-                        genes = dict_genes_mapped_to_read[read]
-                        gene_lengths = list(map(lambda x: refseq_gene_len_dict.get(x), genes))
-                        list(np.float64(gene_lengths))
-                        read_avg_gene_length = Average(gene_lengths)
-                        #print (read,avg_gene_length)
-                        #FuncAvgGeneLengthdict[read].append(avg_gene_length)
-                        FuncLengthArray.append(read_avg_gene_length)
-
-                    FuncAvgGeneLength = Average(FuncLengthArray)
-
-                    numreads = len(readarray)
-                    lengthkb = FuncAvgGeneLength/1000
-                    
-                    if (GE and lengthkb):
-                        rpkg = numreads/lengthkb/GE
-                    else:
-                        rpkg = float('NaN')
-
-                    FuncRPKGdict[func]=float(rpkg)
-                    #print ("Function: " + str(func) + " RPKG: " + str(rpkg))
+    if isinstance(refseq_gene_len_dict, MmapGeneLengthDict):
+        rows = refseq_gene_len_dict.find(unique_genes)
+        unique_lengths = np.where(rows >= 0, refseq_gene_len_dict.lengths[rows], np.nan)
+    else:
+        unique_lengths = np.array([refseq_gene_len_dict.get(gene, np.nan) for gene in unique_genes], dtype=np.float64)
     
-    return FuncRPKGdict
+    return unique_lengths[gene_codes]
+
 
 def parseMicrobeCensusReport(MCRfile):
     d = {}
@@ -488,136 +868,405 @@ def parseMicrobeCensusReport(MCRfile):
 
     return d
 
-def Average(lst):
-    avg=0
-
-    if(len(lst) > 0):
-        avg = float(sum(np.float64(lst)) / len(lst))
-            
-    return avg
-
-            
-def mutate_dict(f,d):
-    new_d = {}
-    # apply a function to all elements of a dict
-    # to generate a new dict
-    for k, v in d.items():
-        new_d[k] = f(v)
+def coreRun(taxaf,taxaft,funcf,funcft,m8,read_ids,hit_ids):
+    # Each file comes back as a pair of int32 arrays: interned read IDs and
+    # the interned taxon, function or hit ID of that line
     
-    return new_d
-
-def coreRun(taxaf,taxaft,funcf,funcft,m8):
-    
-    taxadict = {}
-    funcdict = {}
+    taxadict = emptyCodePairs()
+    funcdict = emptyCodePairs()
+    genedict = emptyCodePairs()
 
     print ("In Core ... >>>:",taxaft,funcft)
     
     if (taxaft == 'megan'):
         print ("Taxatype:Megan\n")
-        taxadict=parseMeganTaxafile(taxaf)
+        taxadict=parseMeganTaxafile(taxaf,read_ids)
     elif (taxaft == 'kraken2'):
         print ("Taxatype:Kraken2\n")
-        taxadict=parseKraken2Taxafile(taxaf)
+        taxadict=parseKraken2Taxafile(taxaf,read_ids)
     else:
         print ("Taxa type not recognised\n")
         
         
     if (funcft == 'megan'):
         print ("Functype:Megan\n")
-        funcdict = parseMeganFuncfile(funcf)
+        funcdict = parseMeganFuncfile(funcf,read_ids)
     elif (funcft == 'uniref'):
         print ("Functype:uniref\n")
-        funcdict = parseUnirefFuncfile(funcf)
+        funcdict = parseUnirefFuncfile(funcf,read_ids)
     elif (funcft == 'COG'):
         print ("Functype:COG\n")
-        funcdict = parseUnirefFuncfile(funcf)
+        funcdict = parseUnirefFuncfile(funcf,read_ids)
     elif (funcft == 'refseq'):
         print ("Functype:refseq\n")
-        funcdict = parseUnirefFuncfile(funcf)
+        funcdict = parseUnirefFuncfile(funcf,read_ids)
     else:
         print ("Func type not recognised\n")
     
     if (m8):
         print ("m8 file given...processing")
-        genedict = parseBlastm8(m8)
+        genedict = parseBlastm8(m8,read_ids,hit_ids)
     
     return taxadict,funcdict,genedict
     
 
-def mergeTaxaFunc(dict1,dict2):
-    # Combine the values with same keys 
-    result = defaultdict(list)
-    # 
-    for d in (dict1,dict2):
-        for k,val in d.items():
-            result[k].append(val)
+def streamRun(taxaf,taxaft,funcf,funcft,m8,rs2ecdict,refseq_gene_len_dict,levels=None,sorted_by_read=False,block_reads=10000):
+    # Single pass over the taxa, function and m8 files of one sample, in the
+    # read order of the kraken2 taxa file (or all sorted by read ID). Only the per-function read counts and gene-length sums are
+    # kept, so memory scales with the number of distinct functions. Reads are
+    # buffered in blocks of block_reads so that the gene lengths and ECs of
+    # their hits are looked up with one vectorized call per block.
+    # Returns the RPKG dicts of every level in levels (default RPKG_LEVELS).
+    
+    print ("In Stream ... >>>:",taxaft,funcft)
+    
+    if levels is None:
+        levels = RPKG_LEVELS
+    rollups = sorted({key for name, keys in levels for key in keys if key in ROLLUP_SOURCES})
+    
+    level_totals = [defaultdict(lambda: [0, 0.0]) for level in levels]
+    tot_reads_mapped,taxa_mapped,func_mapped,taxa_OR_func_mapped,taxa_AND_func_mapped = 0,0,0,0,0
+    funcs_detected, ecs_detected = set(), set()
+    block = []
+    
+    if (sorted_by_read):
+        reads = mergeSortedReads(iterTaxafile(taxaf,taxaft), iterFuncfile(funcf,funcft), iterBlastm8(m8))
+    else:
+        reads = mergeOrderedReads(iterKraken2Reads(taxaf), iterFuncfile(funcf,funcft), iterBlastm8(m8))
+    for read, (taxon, func, genes) in reads:
+        if (genes is not None):
+            tot_reads_mapped += 1
+        if (taxon is not None):
+            taxa_mapped += 1
+        if (func is not None):
+            func_mapped += 1
+        if (taxon is None and func is None):
+            continue
+        taxa_OR_func_mapped += 1
+        if (taxon is None or func is None):
+            continue
+        taxa_AND_func_mapped += 1
+        
+        block.append((taxon, func, genes or []))
+        if (len(block) == block_reads):
+            addStreamBlock(block,rs2ecdict,refseq_gene_len_dict,levels,rollups,level_totals,funcs_detected,ecs_detected)
+            block = []
+    
+    if block:
+        addStreamBlock(block,rs2ecdict,refseq_gene_len_dict,levels,rollups,level_totals,funcs_detected,ecs_detected)
+    
+    print ("Total reads mapped: " + str(tot_reads_mapped))
+    print ("Total reads mapped to taxa: " + str(taxa_mapped))
+    print ("Total reads mapped to functions: " + str(func_mapped))
+    print ("Reads mapped to either taxa OR functions: " + str(taxa_OR_func_mapped))
+    print ("Reads mapped to both taxa AND functions: " + str(taxa_AND_func_mapped))
+    print ("Total unique functions: ", len(funcs_detected))
+    print ("Total ECs detected: ", len(ecs_detected))
+    
+    ge = taxa_AND_func_mapped/1000000
+    
+    return tuple(rpkgFromTotals(totals, ge) for totals in level_totals)
 
-            
-    #first10pairs = {k: result[k] for k in list(result)[10:30]}
-    #print("resultant dictionary : \n", first10pairs) 
-    return result
 
-def parseBlastm8(filename):
-    d = defaultdict(list)
+def addStreamBlock(block,rs2ecdict,refseq_gene_len_dict,levels,rollups,level_totals,funcs_detected,ecs_detected):
+    # Add a block of (taxon, function, hit IDs) reads to the per-level totals of streamRun
+    hit_counts = np.fromiter((len(genes) for taxon, func, genes in block), dtype=np.int64, count=len(block))
+    hit_codes, unique_hits = pd.factorize(np.array([gene for taxon, func, genes in block for gene in genes], dtype=object))
+    
+    read_avg_gene_length = runMeans(hit_counts, geneLengthArray(unique_hits, refseq_gene_len_dict)[hit_codes])
+    modal_ec, ec_names = modalECs(hit_counts, hit_codes, list(unique_hits), rs2ecdict)
+    
+    for (taxon, func, genes), avg_gene_length, ec in zip(block, read_avg_gene_length.tolist(), modal_ec.tolist()):
+        funcs_detected.add(func)
+        labels = {'function': func, 'taxon': taxon, 'ec': None}
+        if (ec >= 0):
+            labels['ec'] = "EC:" + str(ec_names[ec])
+            ecs_detected.add(labels['ec'])
+        for name in rollups:
+            source = labels[ROLLUP_SOURCES[name]]
+            labels[name] = None if source is None else rollupLabel(name, source)
+        
+        for (name, keys), totals in zip(levels, level_totals):
+            key_labels = [labels[key] for key in keys]
+            if None in key_labels:
+                continue
+            totals['|'.join(key_labels)][0] += 1
+            totals['|'.join(key_labels)][1] += avg_gene_length
+
+
+def rpkgFromTotals(func_totals, GE):
+    # Same normalization as aggregateRpkg, but starting from the
+    # [number of reads, sum of per-read average gene lengths] of each function
+    FuncRPKGdict = defaultdict(list)
+    
+    for func, (numreads, lengthsum) in func_totals.items():
+        lengthkb = lengthsum/numreads/1000
+        
+        if (GE and lengthkb):
+            rpkg = numreads/lengthkb/GE
+        else:
+            rpkg = float('NaN')
+        
+        FuncRPKGdict[func] = float(rpkg)
+    
+    return FuncRPKGdict
+
+
+def joinTaxaFunc(taxaf,taxaft,funcf,funcft,read_ids,sort_chunk_lines):
+    # Sorted-merge (inner) join of the taxa and function files on read ID.
+    # Returns the interned (read, taxon) and (read, function) code pairs of the
+    # reads found in both files and the (taxa, function, either) read counts.
+    
+    print ("In Merge Join ... >>>:",taxaft,funcft)
+    
+    taxon_ids, func_ids = globalInterner('taxon'), globalInterner('function')
+    keys, taxa, funcs = array('i'), array('i'), array('i')
+    taxa_mapped,func_mapped,taxa_OR_func_mapped = 0,0,0
+    
+    with tempfile.TemporaryDirectory(prefix='merge_join_') as tmpdir:
+        taxa_pairs = sortedReadPairs(lambda: iterTaxafile(taxaf,taxaft), tmpdir, sort_chunk_lines)
+        func_pairs = sortedReadPairs(lambda: iterFuncfile(funcf,funcft), tmpdir, sort_chunk_lines)
+        
+        for read, (taxon, func) in mergeSortedReads(taxa_pairs, func_pairs):
+            taxa_OR_func_mapped += 1
+            if (taxon is not None):
+                taxa_mapped += 1
+            if (func is not None):
+                func_mapped += 1
+            if (taxon is None or func is None):
+                continue
+            keys.append(read_ids.code(read))
+            taxa.append(taxon_ids.code(taxon))
+            funcs.append(func_ids.code(func))
+    
+    return codePairs(keys,taxa), codePairs(keys,funcs), (taxa_mapped,func_mapped,taxa_OR_func_mapped)
+
+
+def sortedReadPairs(pairs,tmpdir,chunk_lines):
+    # (read, value) pairs from the generator function pairs, in read ID order and
+    # keeping only the last value of a read (like loading them into a dict).
+    # Input that is already sorted is streamed as is; anything else is sorted on
+    # disk in runs of chunk_lines pairs that are then merged.
+    previous = None
+    for read, value in pairs():
+        if (previous is not None and read < previous):
+            break
+        previous = read
+    else:
+        return lastPairPerRead(pairs())
+    
+    print ("Input not sorted by read ID, sorting on disk ...")
+    
+    runs = []
+    chunk = []
+    for pair in pairs():
+        chunk.append(pair)
+        if (len(chunk) == chunk_lines):
+            runs.append(writeSortedRun(chunk, tmpdir))
+            chunk = []
+    if chunk:
+        runs.append(writeSortedRun(chunk, tmpdir))
+    
+    # heapq.merge yields equal reads in run order, i.e. in file order
+    return lastPairPerRead(heapq.merge(*(iterSortedRun(run) for run in runs), key=itemgetter(0)))
+
+
+def writeSortedRun(chunk,tmpdir):
+    chunk.sort(key=itemgetter(0))
+    with tempfile.NamedTemporaryFile('w', dir=tmpdir, suffix='.run', delete=False) as f:
+        for read, value in chunk:
+            f.write(read + "\t" + value + "\n")
+    return f.name
+
+
+def iterSortedRun(filename):
+    with open(filename) as f:
+        for line in f:
+            read, value = line.rstrip('\n').split("\t", 1)
+            yield read, value
+
+
+def lastPairPerRead(pairs):
+    # Collapse consecutive pairs of the same read to the last one
+    read, value = None, None
+    for pair in pairs:
+        if (read is not None and pair[0] != read):
+            yield read, value
+        read, value = pair
+    if (read is not None):
+        yield read, value
+
+
+def mergeSortedReads(*iterators):
+    # Walk several (read, value) iterators sorted by read ID in step, yielding
+    # every read once together with the value from each iterator (None if absent)
+    heads = [next(it, None) for it in iterators]
+    
+    while True:
+        keys = [head[0] for head in heads if head is not None]
+        if not keys:
+            return
+        read = min(keys)
+        values = []
+        
+        for i, it in enumerate(iterators):
+            head = heads[i]
+            if (head is None or head[0] != read):
+                values.append(None)
+                continue
+            values.append(head[1])
+            head = next(it, None)
+            if (head is not None and head[0] <= read):
+                raise InputError('Input files are not sorted by read ID (' + head[0] + ' follows ' + read + '); sort them with LC_ALL=C sort before using --sorted_by_read')
+            heads[i] = head
+        
+        yield read, values
+
+
+def mergeOrderedReads(reads,*iterators):
+    # Walk (read, value) iterators in step with reads, the (read, value) pairs of
+    # every read, when each iterator lists some of those reads in the same order.
+    # Yields every read of reads with its value and the value from each iterator
+    # (None if absent).
+    heads = [next(it, None) for it in iterators]
+    
+    for read, value in reads:
+        values = [value]
+        for i, it in enumerate(iterators):
+            head = heads[i]
+            if (head is None or head[0] != read):
+                values.append(None)
+                continue
+            values.append(head[1])
+            heads[i] = next(it, None)
+        
+        yield read, values
+    
+    # An iterator that is left over had a read that reads lacks, or out of order
+    for head in heads:
+        if (head is not None):
+            raise InputError('Read ' + head[0] + ' of the function or m8 file is missing from the kraken2 file or out of its read order; sort all three files by read ID and use --sorted_by_read')
+
+
+def iterKraken2Reads(filename):
+    # (read, taxon) of every read of a kraken2 output in file order, with
+    # taxon None for unclassified reads
+    with open(filename) as f:
+        for line in f:
+            fields = line.rstrip('\n').split("\t")
+            yield fields[1], (fields[2] if fields[0] == 'C' else None)
+
+
+def iterTaxafile(filename,filetype):
+    # (read, taxon) pairs of a kraken2 or megan taxa file, in file order
+    if (filetype not in ('kraken2', 'megan')):
+        print ("Taxa type not recognised\n")
+        return
+    
+    with open(filename) as f:
+        for line in f:
+            fields = line.rstrip('\n').split("\t")
+            if (filetype == 'megan'):
+                yield fields[0], fields[1]
+            elif (fields[0] == 'C'):
+                yield fields[1], fields[2]
+
+
+def iterFuncfile(filename,filetype):
+    # (read, function) pairs of a function file, in file order
+    if (filetype not in ('megan', 'uniref', 'COG', 'refseq')):
+        print ("Func type not recognised\n")
+        return
+    
+    with open(filename) as f:
+        for line in f:
+            fields = line.rstrip('\n').split("\t")
+            yield fields[0], fields[1]
+
+
+def iterBlastm8(filename):
+    # (read, list of hit IDs) for each run of consecutive lines with the same read
+    read, hits = None, []
+    
+    with open(filename) as f:
+        for line in f:
+            fields = line.split("\t")
+            if (fields[0] != read):
+                if hits:
+                    yield read, hits
+                read, hits = fields[0], []
+            hits.append(fields[1])
+    
+    if hits:
+        yield read, hits
+
+
+def emptyCodePairs():
+    return (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+
+
+def codePairs(keys,vals):
+    return (np.frombuffer(keys, dtype=np.int32), np.frombuffer(vals, dtype=np.int32))
+
+
+def parseBlastm8(filename,read_ids,hit_ids):
+    keys, vals = array('i'), array('i')
     print ("In m8 parse ... ")
     
     with open(filename) as f:
         for line in f:
-            #(key, val) = line.split("\t")
             fields = line.split("\t")
-            key = fields[0]
-            val = fields[1] 
-            #d[str(key)] = str(val)
-            d[key].append(val)
+            keys.append(read_ids.code(fields[0]))
+            vals.append(hit_ids.code(fields[1]))
             
-    #first10pairs = {k: d[k] for k in list(d)[10:20]}
-    #print("resultant dictionary : \n", first10pairs) 
-    return d
+    return codePairs(keys,vals)
 
     
-def parseUnirefFuncfile(filename):
+def parseUnirefFuncfile(filename,read_ids):
     
-    d = {}
+    func_ids = globalInterner('function')
+    keys, vals = array('i'), array('i')
     print ("In Uniref Parsed func ... ")
     with open(filename) as f:
         for line in f:
-            #fields = line.split("\t")
             (key, val) = line.replace('\n', '').split("\t")
-            d[str(key)] = str(val)
-    return d
+            keys.append(read_ids.code(key))
+            vals.append(func_ids.code(val))
+    return codePairs(keys,vals)
 
 
-def parseMeganFuncfile(filename):
-    d = {}
+def parseMeganFuncfile(filename,read_ids):
+    func_ids = globalInterner('function')
+    keys, vals = array('i'), array('i')
     print ("In Megan func ... ")
     with open(filename) as f:
         for line in f:
-            #fields = line.split("\t")
             (key, val) = line.split("\t")
-            d[str(key)] = str(val)
-    return d
+            keys.append(read_ids.code(key))
+            vals.append(func_ids.code(val.rstrip('\n')))
+    return codePairs(keys,vals)
 
-def parseMeganTaxafile(filename):
-    d = {}
+def parseMeganTaxafile(filename,read_ids):
+    taxon_ids = globalInterner('taxon')
+    keys, vals = array('i'), array('i')
     with open(filename) as f:
         for line in f:
             (key, val) = line.split("\t")
-            d[str(key)] = str(val)
-    return d        
+            keys.append(read_ids.code(key))
+            vals.append(taxon_ids.code(val.rstrip('\n')))
+    return codePairs(keys,vals)
 
-def parseKraken2Taxafile(filename):
-    d = {}
+def parseKraken2Taxafile(filename,read_ids):
+    taxon_ids = globalInterner('taxon')
+    keys, vals = array('i'), array('i')
     with open(filename) as f:
         for line in f:
             fields = line.replace('\n', '').split("\t")
             classified = fields[0]
-            key = fields[1]
-            val = fields[2]    
-            #print (fields[0])
             if (classified == 'C'):
-                d[str(key)] = str(val)
-    return d
+                keys.append(read_ids.code(fields[1]))
+                vals.append(taxon_ids.code(fields[2]))
+    return codePairs(keys,vals)
 
 if __name__ == "__main__":
     main();
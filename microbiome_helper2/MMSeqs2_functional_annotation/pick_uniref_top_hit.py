@@ -3,11 +3,22 @@ from operator import itemgetter
 
 import argparse, sys, textwrap
 import os
+import hashlib
+import shutil
+import multiprocessing
 
 parser=argparse.ArgumentParser()
 
 parser.add_argument('--unirefm8Dir', help = 'Folder containing m8 files mapping the reads to Uniref')
 parser.add_argument('--output_path', help = 'Path to the directory where the parsed output will be stored')
+parser.add_argument('--streaming', action = 'store_true', help = 'Single pass over each m8 file keeping only the best hit per read (lowest E-value, then highest bitscore, then highest identity)')
+parser.add_argument('--sorted_by_query', action = 'store_true', help = textwrap.dedent('''The m8 files are grouped by query (as written by MMseqs2), so each read is written out as soon as its hits end
+    and memory stays constant; implies --streaming. A read whose hits are not contiguous is written once per run of hits
+    '''))
+parser.add_argument('--check_grouping', action = 'store_true', help = 'With --sorted_by_query, exit with an error if the hits of a read are not contiguous; keeps an 8-byte hash of every read written, so memory grows with the number of reads')
+parser.add_argument('--jobs', type = int, default = 1, help = 'Number of m8 files (or chunks of files) to parse in parallel (default: 1)')
+parser.add_argument('--chunk_size', type = int, default = 1024, help = 'With --jobs and --sorted_by_query, m8 files larger than this many MB are split into chunks on query boundaries that are parsed in parallel (default: 1024)')
+parser.add_argument('--resume', action = 'store_true', help = 'Skip outputs (and chunks of outputs) that already have a .done completion marker from an earlier run')
 
 def main():
     args = parser.parse_args()
@@ -16,13 +27,53 @@ def main():
     folderN=args.unirefm8Dir
     #print (unirefFileList, type(unirefFileList))
     
+    streaming = args.streaming or args.sorted_by_query
+    chunk_bytes = args.chunk_size * 1024 * 1024
+    tasks = []
+    chunked_outputs = []
+    
     #for m8 in unirefFileList:
     for root, dirs, files in os.walk(folderN, topdown=False):
         
         for m8 in files:
             filepath=str(os.path.join(root, m8))
             outfilename = outpath + "/" + m8 + "-parsed.txt"
-            parseunirefm8(filepath,outfilename)
+            if (args.resume and os.path.exists(outfilename + ".done")):
+                print ("Skipping completed output:", outfilename)
+                continue
+            
+            # Only files grouped by query can be cut into independent chunks
+            if (args.jobs > 1 and args.sorted_by_query and os.path.getsize(filepath) > chunk_bytes):
+                offsets = query_aligned_offsets(filepath,chunk_bytes)
+                parts = [outfilename + ".part" + str(i) for i in range(len(offsets) - 1)]
+                for i, part in enumerate(parts):
+                    if not (args.resume and os.path.exists(part + ".done")):
+                        tasks.append((filepath,part,streaming,args.sorted_by_query,args.check_grouping,offsets[i],offsets[i + 1]))
+                chunked_outputs.append((outfilename,parts))
+            else:
+                tasks.append((filepath,outfilename,streaming,args.sorted_by_query,args.check_grouping,0,None))
+    
+    # Tasks fail with InputError rather than sys.exit: a SystemExit in a pool
+    # worker kills it without returning, and starmap then waits forever
+    try:
+        if (args.jobs > 1):
+            with multiprocessing.Pool(args.jobs) as pool:
+                pool.starmap(parse_m8_task, tasks)
+        else:
+            for task in tasks:
+                parse_m8_task(*task)
+    except InputError as e:
+        sys.exit(str(e))
+    
+    for outfilename, parts in chunked_outputs:
+        with open(outfilename,"w") as ofh:
+            for part in parts:
+                with open(part) as pfh:
+                    shutil.copyfileobj(pfh,ofh)
+        mark_done(outfilename)
+        for part in parts:
+            os.remove(part)
+            os.remove(part + ".done")
         #first10pairs = {k: reads_to_UPids_hash[k] for k in list(reads_to_UPids_hash)[10:20]}
         #print("resultant dictionary readsToUP: \n", first10pairs)
         #for re in first10pairs:
@@ -30,6 +81,72 @@ def main():
             #print (type(tup_list))
     
 
+class InputError(Exception):
+    # Bad m8 input found while parsing; main() exits with its message
+    pass
+
+
+def parse_m8_task(filename,outf,streaming,sorted_by_query,check_grouping,start,end):
+    # Parse one m8 file, or the byte range [start, end) of it, and mark the
+    # output as complete so that --resume can skip it
+    if (streaming):
+        with open(outf,"w+") as ofh:
+            try:
+                for read, top_UP_id in stream_top_hits(read_m8_range(filename,start,end),sorted_by_query,check_grouping):
+                    ofh.write(read + '\t' + top_UP_id + '\n')
+            except InputError as e:
+                raise InputError(filename + ': ' + str(e))
+    else:
+        parseunirefm8(filename,outf)
+    mark_done(outf)
+
+
+def mark_done(outf):
+    with open(outf + ".done","w") as fh:
+        fh.write("")
+
+
+def read_m8_range(filename,start,end):
+    # Lines of an m8 file from byte offset start up to end (None for the end of the file)
+    pos = start
+    with open(filename,'rb') as f:
+        f.seek(start)
+        for line in f:
+            if (end is not None and pos >= end):
+                break
+            pos += len(line)
+            yield line.decode()
+
+
+def query_aligned_offsets(filename,chunk_bytes):
+    # Byte offsets cutting an m8 file that is grouped by query into chunks of
+    # about chunk_bytes, each cut falling between the hits of two different reads
+    size = os.path.getsize(filename)
+    offsets = [0]
+    
+    with open(filename,'rb') as f:
+        while offsets[-1] + chunk_bytes < size:
+            f.seek(offsets[-1] + chunk_bytes)
+            f.readline()
+            query = None
+            while True:
+                pos = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                read = line.split(b'\t', 1)[0]
+                if query is None:
+                    query = read
+                elif read != query:
+                    break
+            if (pos >= size):
+                break
+            offsets.append(pos)
+    
+    offsets.append(size)
+    return offsets
+
+
 def parseunirefm8(filename,outf):
     d = defaultdict(list)
     ofh= open(outf,"w+")
@@ -60,6 +177,43 @@ def parseunirefm8(filename,outf):
     
     return d
 
+def stream_top_hits(lines,sorted_by_query,check_grouping=False):
+    # Yield (read, best UniRef ID) from m8 lines while keeping only the current
+    # best hit of each read. Hits are ranked by E-value, then bitscore, then
+    # identity; complete ties keep the hit seen first. Reads come out in order
+    # of first appearance. With sorted_by_query each read is written as soon
+    # as its hits end; check_grouping then remembers a hash of every read
+    # written and rejects a read whose hits turn up again later.
+    best = {}
+    current_read = None
+    emitted = set()
+    
+    for line in lines:
+        fields = line.rstrip('\n').split("\t")
+        read = fields[0]
+        rank = (float(fields[10]), -float(fields[11]), -float(fields[2]))
+        
+        if (sorted_by_query and read != current_read):
+            if current_read is not None:
+                yield current_read, best.pop(current_read)[1]
+                if (check_grouping):
+                    emitted.add(read_hash(current_read))
+            if (check_grouping and read_hash(read) in emitted):
+                raise InputError('Hits of ' + read + ' are not grouped together; run without --sorted_by_query')
+            current_read = read
+        
+        if (read not in best or rank < best[read][0]):
+            best[read] = (rank, fields[1])
+    
+    for read, (rank, UPid) in best.items():
+        yield read, UPid
+
+
+def read_hash(read):
+    # 64-bit hash of a read ID, smaller than the ID itself and stable across processes
+    return int.from_bytes(hashlib.blake2b(read.encode(), digest_size=8).digest(), 'little')
+
+
 def pick_top_hit(tupList):
     di = {}
     di = dict(tupList)